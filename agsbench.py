@@ -0,0 +1,282 @@
+""" Benchmark the grading pipeline on a synthetic class.
+
+Generates a Moodle zip of fake students, some with compile errors or
+infinite loops, and runs the `unzip` (extraction in `precheck()`), `rename`,
+`javac_all`, `java_all` and `checkstyle_all` stages on it in batch mode.
+Prints per-stage wall time, throughput and the peak RSS so far as JSON, for
+example:
+
+```text
+python3 agsbench.py -n 100 --stub --jobs 4 > before.json
+python3 agsbench.py -n 100 --stub --jobs 4 --args="--batchcompile"
+```
+
+With `--stub`, javac, java and checkstyle are replaced by shell scripts, so
+the numbers show the overhead of the grader itself.
+
+The RSS is the maximum over the whole process up to the end of a stage, as
+`getrusage()` reports it: a stage that does not raise it shows the value of
+an earlier one. It only tells which stage first reached the peak.
+"""
+
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import random
+import resource
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+import agscore
+import agsdb
+import agsmsg as msg
+import agsutil as util
+
+HOME = os.path.dirname(os.path.abspath(__file__))
+
+STUB_JAVAC = '''#!/bin/sh
+rc=0
+for f in "$@"; do
+    case "$f" in *.java) ;; *) continue ;; esac
+    if grep -q 'COMPILE ERROR' "$f"; then
+        echo "$f:3: error: illegal start of expression" >&2
+        rc=1
+    else
+        touch "${f%.java}.class"
+    fi
+done
+[ $rc -ne 0 ] && echo "1 error" >&2
+exit $rc
+'''
+
+STUB_JAVA = '''#!/bin/sh
+for cls; do :; done
+grep -q 'INFINITE LOOP' "$cls.java" 2>/dev/null && exec sleep 3600
+echo "Output of $cls"
+'''
+
+STUB_CHECKSTYLE = '''#!/bin/sh
+for f; do echo "[WARN] $f:1: Missing a Javadoc comment."; done
+'''
+
+STAGES = [('unzip', lambda: agscore.precheck()),
+          ('rename', lambda: agscore.rename()),
+          ('javac_all', lambda: agscore.javac_all()),
+          ('java_all', lambda: agscore.java_all()),
+          ('checkstyle_all', lambda: agscore.checkstyle_all())]
+
+
+def java_source(cls, lines, error=False, loop=False):
+    """ Return a Java class with a main of about `lines` lines. """
+
+    body = [f'        total += {i} * args.length;' for i in range(lines)]
+    if error:
+        body.insert(0, '        int broken = ; // COMPILE ERROR')
+    if loop:
+        body.append('        while (total >= 0) { // INFINITE LOOP')
+        body.append('            total = 0;')
+        body.append('        }')
+    return '\n'.join([f'public class {cls} {{',
+                      '    public static void main(String[] args) {',
+                      '        int total = 0;'] + body +
+                     ['        System.out.println(total);',
+                      '    }',
+                      '}', ''])
+
+
+def generate(path, options):
+    """ Write a Moodle zip of `options.students` students to `path`.
+    Return the names of the Java files every student submits.
+    """
+
+    rng = random.Random(options.seed)
+    files = [f'Bench{i}.java' for i in range(options.files)]
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for i in range(options.students):
+            error = rng.random() < options.errors
+            loop = not error and rng.random() < options.loops
+            folder = f'Student{i:04d} Bench__{i}_assignsubmission_file_'
+            for j, f in enumerate(files):
+                source = java_source(f[:-5], options.lines,
+                                     error and j == 0, loop and j == 0)
+                zf.writestr(f'{folder}/{f}', source)
+    return files
+
+
+def install_stubs(root):
+    """ Put the stub tools first on PATH and checkstyle into ~ of `root`. """
+
+    bin_ = os.path.join(root, 'bin')
+    os.makedirs(bin_)
+    os.makedirs(os.path.join(root, 'cs-checkstyle'))
+    for path, script in [(os.path.join(bin_, 'javac'), STUB_JAVAC),
+                         (os.path.join(bin_, 'java'), STUB_JAVA),
+                         (os.path.join(root, 'cs-checkstyle', 'checkstyle'),
+                          STUB_CHECKSTYLE)]:
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = f'{bin_}{os.pathsep}{os.environ["PATH"]}'
+    os.environ['HOME'] = root
+
+
+def peak_rss():
+    """ Return the peak RSS in KiB of this process and of its children,
+    since the process started.
+    """
+
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+
+@contextmanager
+def redirect_output(path):
+    """ Send everything written to stdout and stderr, including the output
+    of subprocesses, to the file `path`.
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    with open(path, 'a') as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+
+
+def bench(options):
+    """ Run all stages on a generated class and return the results. """
+
+    root = tempfile.mkdtemp(prefix='ags-bench-')
+    asmt = os.path.join(root, 'content', 'exercise', 'day00')
+    os.makedirs(asmt)
+    os.symlink(os.path.join(HOME, 'lib'), os.path.join(root, 'lib'))
+    files = generate(os.path.join(asmt, 'CSC 116 bench.zip'), options)
+    if options.stub:
+        install_stubs(root)
+
+    util.read_config_glob(os.path.join(HOME, 'config', 'config.yaml'))
+    util.__assignment_config__ = {'files': files, 'src': files, 'test': []}
+    agscore.args = agscore.build_parser().parse_args(
+        ['-e', '0', '--batch', '--jobs', str(options.jobs),
+         '--timeout', str(options.timeout)] + shlex.split(options.args))
+    agscore.asmt_name, agscore.asmt_num = 'day', '00'
+    agscore.asmt_disp_name = 'Benchmark'
+    agscore.path_lib = util.get_conf_glob('lib')
+    agscore.default_open = util.get_conf_glob('open')
+    msg.batch()
+
+    cwd = os.getcwd()
+    os.chdir(asmt)
+    agsdb.open_db('ags.db')
+    stages = {}
+    log = os.path.join(root, 'output.log')
+    try:
+        for name, stage in STAGES:
+            with redirect_output(os.devnull if not options.keep else log):
+                start = time.perf_counter()
+                stage()
+                seconds = time.perf_counter() - start
+            rss, children = peak_rss()
+            stages[name] = {
+                'seconds': round(seconds, 4),
+                'students_per_second': round(options.students / seconds, 2)
+                if seconds else None,
+                'max_rss_so_far_kib': rss,
+                'children_max_rss_so_far_kib': children}
+        failed = {}
+        for _, step, _, fails, _, _ in agsdb.summary():
+            failed[step] = failed.get(step, 0) + (fails or 0)
+    finally:
+        agsdb.close()
+        os.chdir(cwd)
+        if options.keep:
+            print(f'Kept {root}', file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    with open(os.path.join(HOME, 'VERSION')) as f:
+        version = f.read().strip()
+    return {'version': version,
+            'python': sys.version.split()[0],
+            'students': options.students,
+            'files': options.files,
+            'lines': options.lines,
+            'stub': options.stub,
+            'jobs': options.jobs,
+            'args': options.args,
+            'failed': failed,
+            'stages': stages}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the grading pipeline on a synthetic class.')
+    parser.add_argument('-n', '--students',
+                        help='number of students (default: 50)',
+                        type=int,
+                        default=50)
+    parser.add_argument('--files',
+                        help='Java files per student (default: 2)',
+                        type=int,
+                        default=2)
+    parser.add_argument('--lines',
+                        help='lines per Java file (default: 100)',
+                        type=int,
+                        default=100)
+    parser.add_argument('--errors',
+                        help='share of students with a compile error '
+                        '(default: 0.1)',
+                        type=float,
+                        default=0.1)
+    parser.add_argument('--loops',
+                        help='share of students with an infinite loop '
+                        '(default: 0.05)',
+                        type=float,
+                        default=0.05)
+    parser.add_argument('--timeout',
+                        help='seconds before a program is killed '
+                        '(default: 2)',
+                        type=float,
+                        default=2)
+    parser.add_argument('--seed',
+                        help='seed of the generated class',
+                        type=int,
+                        default=116)
+    parser.add_argument('--stub',
+                        help='use stub javac, java and checkstyle',
+                        action='store_true')
+    parser.add_argument('--jobs',
+                        help='value of agscore --jobs',
+                        type=int,
+                        default=1)
+    parser.add_argument('--args',
+                        help='more agscore options, e.g. "--batchcompile"',
+                        default='')
+    parser.add_argument('--keep',
+                        help='keep the generated class and the output log',
+                        action='store_true')
+    parser.add_argument('-o', '--output',
+                        help='write the JSON to a file instead of stdout')
+
+    options = parser.parse_args()
+    text = json.dumps(bench(options), indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(f'{text}\n')
+    else:
+        print(text)
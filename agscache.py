@@ -0,0 +1,138 @@
+""" Content-addressed cache of compile results.
+
+An entry is keyed by the Java sources of a student, the jars on the
+classpath and the javac version. It stores the produced `.class` files and
+the per-file results, so an unchanged submission is restored instead of
+compiled again. Entries are evicted least recently used first.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess as sp
+import tempfile
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def javac_version():
+    """ Return the output of `javac -version` (empty if not available). """
+
+    try:
+        proc = sp.run(['javac', '-version'], stdout=sp.PIPE, stderr=sp.STDOUT)
+    except OSError:
+        return ''
+    return proc.stdout.decode(encoding='utf-8').strip()
+
+
+@lru_cache(maxsize=None)
+def _digest_file(path, mtime, size):
+    """ Return the SHA-256 of a file. Memoized on its mtime and size. """
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def digest_file(path):
+    """ Return the SHA-256 of a file, or `None` if it does not exist. """
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return _digest_file(os.path.abspath(path), st.st_mtime, st.st_size)
+
+
+def classpath_files(cwd, classpath):
+    """ Return the files and directories on `classpath`, resolved against
+    `cwd`. A `dir/*` entry expands to the jars in dir.
+    """
+
+    entries = []
+    for e in classpath.split(os.pathsep):
+        path = os.path.join(cwd, e)
+        if os.path.basename(e) == '*':
+            entries.extend(sorted(glob.glob(os.path.join(os.path.dirname(path),
+                                                         '*.jar'))))
+        elif e:
+            entries.append(path)
+    return entries
+
+
+def key(cwd, files, classpath, mode=''):
+    """ Return the cache key for compiling `files` in `cwd`. `mode` holds
+    everything else that changes the result, such as the commands.
+    """
+
+    h = hashlib.sha256()
+    h.update(f'{javac_version()}\0{mode}\0{classpath}\0'.encode())
+    h.update('\0'.join(files).encode())
+    # javac also compiles sources that the listed files depend on
+    for src in sorted(glob.glob(os.path.join(cwd, '*.java'))):
+        h.update(f'\0{os.path.basename(src)}\0{digest_file(src)}'.encode())
+    for jar in classpath_files(cwd, classpath):
+        if os.path.isfile(jar):
+            h.update(f'\0{jar}\0{digest_file(jar)}'.encode())
+    return h.hexdigest()
+
+
+def get(cache, key_, cwd):
+    """ Restore the class files of an entry into `cwd` and return its
+    results, or `None` on a miss.
+    """
+
+    entry = os.path.join(cache, key_)
+    try:
+        with open(os.path.join(entry, 'results.json')) as f:
+            results = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    for cls in glob.glob(os.path.join(entry, '*.class')):
+        shutil.copy2(cls, cwd)
+    os.utime(entry)
+    return results
+
+
+def put(cache, key_, cwd, results):
+    """ Store the class files in `cwd` and `results` as an entry. """
+
+    os.makedirs(cache, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache, prefix='.tmp-')
+    for cls in glob.glob(os.path.join(cwd, '*.class')):
+        shutil.copy2(cls, tmp)
+    with open(os.path.join(tmp, 'results.json'), 'w') as f:
+        json.dump(results, f)
+    try:
+        os.rename(tmp, os.path.join(cache, key_))
+    except OSError:
+        # Stored concurrently by a student with identical sources
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def prune(cache, limit):
+    """ Remove least recently used entries until the cache is at most
+    `limit` bytes.
+    """
+
+    if not os.path.isdir(cache):
+        return
+    entries = []
+    total = 0
+    for entry in os.scandir(cache):
+        if not entry.is_dir() or entry.name.startswith('.tmp-'):
+            continue
+        size = sum(f.stat().st_size for f in os.scandir(entry.path))
+        entries.append((entry.stat().st_mtime, size, entry.path))
+        total += size
+
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
@@ -1,106 +1,409 @@
 import argparse
-import distutils.dir_util
+import atexit
+import fnmatch
 import glob
+import hashlib
+import json
 import os
+import re
+import shlex
 import shutil
 import subprocess as sp
 import sys
-import webbrowser
-import zipfile
+import tempfile
+import time
 
+import agscache
+import agsdaemon
+import agsdb
+import agsjunit
 import agsmsg as msg
+import agsrun
+import agstrace
 import agsutil as util
 
+# asyncio, concurrent.futures, webbrowser and zipfile take a noticeable
+# share of the startup time, so they are imported where they are used, as
+# are the modules of the commands that need them
 
+
+@agstrace.stage
 def precheck():
     """ Pre-check the assignment structure before starting grading. """
 
-    if not msg.ask_yn(f'Continue with {msg.underline(asmt_disp_name)}?'):
-        print('Bye:)')
+    if not msg.ask_yn(f'Continue with {msg.underline(asmt_disp_name)}?',
+                      default=True):
+        msg.echo('Bye:)')
         exit(0)
 
     link = util.get_link(f'{asmt_name}{asmt_num}')
-    if msg.ask_yn('Open link in browser?'):
+    if msg.ask_yn('Open link in browser?', default=False):
+        import webbrowser
         msg.info(f'Opening {msg.underline(link)}...')
         webbrowser.open_new_tab(link)
 
-    if not os.path.exists('submission'):
-        if len(glob.glob('CSC 116*.zip')) == 0:
-            return 1
-        msg.info('Extracting...')
-        g = glob.glob('CSC 116*.zip')
-        if len(g) == 1:
-            unzip(g[0])
+    zips = sorted(glob.glob('CSC 116*.zip'), key=os.path.getmtime)
+    if not zips:
+        return 0 if os.path.exists('submission') else 1
+
+    # Later zips (e.g. late submissions) replace files of earlier ones
+    exts = util.get_conf_asmt('extensions')
+    manifest = {}
+    ids = {}
+    extracted, skipped = extract(zips, exts, manifest, ids)
+    save_participants(ids)
+    msg.info(f'{extracted} extracted, {skipped} up to date')
+
+    global changed, submitted
+    submitted = manifest
+    changed = changed_students(manifest)
+    if args.incremental:
+        msg.info(f'{len(changed)} new or changed submission(s)')
 
     return 0
 
 
-def unzip(file):
-    with zipfile.ZipFile(file) as f:
-        f.extractall('submission')
+# Manifest of the submitted files of every student when they were last
+# graded, see `save_manifest()`
+MANIFEST = '.ags-manifest.json'
+# `{student: {file: [crc, size]}}` of the zips of this run
+submitted = {}
+# Students whose submission changed since the last run (`None` if unknown)
+changed = None
 
 
-def rename():
-    """ Rename all directories to [firstname lastname]. """
+def load_manifest():
+    """ Return the stored manifest, `{}` if there is none. """
+
+    try:
+        with open(MANIFEST) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def changed_students(manifest):
+    """ Return the names of students whose files in `manifest` were added
+    or changed since they were last graded.
+    """
+
+    previous = load_manifest()
+    return {student for student, files in manifest.items()
+            if previous.get(student) != files}
+
+
+def save_manifest(names):
+    """ Store the submitted files of the students `names` in the manifest,
+    once their grading has finished. Other students keep their entries, so
+    a run limited with `--student` does not hide changes of the rest.
+    """
+
+    manifest = load_manifest()
+    manifest.update((n, submitted[n]) for n in names if n in submitted)
+    with open(MANIFEST, 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
 
-    msg.info('Renaming...')
 
-    moodle_sub_specifier = '_assignsubmission_file_'
-    g = glob.glob(f'submission/*{moodle_sub_specifier}')
+# Suffix of the directory of a student in a Moodle zip
+MOODLE_SUBMISSION = '_assignsubmission_file_'
+# Moodle participant ids of the students, see `save_participants()`
+PARTICIPANTS = '.ags-participants.json'
+
+
+def participant(folder):
+    """ Return the participant id in the name of a Moodle submission
+    folder `[name]__[id]_assignsubmission_file_`, or `None`.
+    """
+
+    match = re.search(r'_(\d+)' + MOODLE_SUBMISSION + '$', folder)
+    return match.group(1) if match else None
+
+
+def load_participants():
+    """ Return the stored `{student: participant id}`. """
+
+    try:
+        with open(PARTICIPANTS) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_participants(ids):
+    """ Add `{student: participant id}` to the stored ids. The folder
+    names lose the ids, so they are kept for the gradebook export.
+    """
+
+    if not ids:
+        return
+    stored = load_participants()
+    stored.update(ids)
+    with open(PARTICIPANTS, 'w') as f:
+        json.dump(stored, f, sort_keys=True)
+
+
+def extract(zips, exts=None, manifest=None, participants=None):
+    """ Extract Moodle zips member by member, straight into
+    submission/[lastname firstname].
+    A file in a later zip replaces the same file of an earlier one before
+    anything is written, so every file is extracted at most once.
+    Only files with an extension in `exts` are written (all if `None`). A
+    file on disk is only replaced if the zips have another version than
+    when it was extracted (see `EXTRACTED`), so fixes of the grader stay.
+    The CRC and size of every file are added to `manifest` by student, and
+    the Moodle participant id of every student to `participants`.
+    Return the number of extracted and skipped files.
+    """
+
+    import zipfile
+
+    exts = {e.lower() for e in exts} if exts else None
+    extracted, skipped = 0, 0
+    versions = load_extracted()
+    archives = []
+    try:
+        # {path: (zip, member, parts)} of the latest version of every file
+        latest = {}
+        for file in zips:
+            msg.info(f'Reading {msg.underline(file)}...')
+            zf = zipfile.ZipFile(file)
+            archives.append(zf)
+            members = [m for m in zf.infolist() if not m.is_dir()]
+            if not any(MOODLE_SUBMISSION in m.filename for m in members):
+                msg.warn('Directory names do not match, extracting as is')
+
+            for member in members:
+                parts = member.filename.split('/')
+                if '..' in parts or os.path.isabs(member.filename):
+                    msg.warn(f'Skipping {msg.underline(member.filename)}')
+                    continue
+                if exts and \
+                        os.path.splitext(parts[-1])[1].lower() not in exts:
+                    continue
+                if MOODLE_SUBMISSION in parts[0]:
+                    id_ = participant(parts[0])
+                    parts[0] = parts[0].split('__')[0]
+                    if participants is not None and id_:
+                        participants[parts[0]] = id_
+                latest[os.path.join('submission', *parts)] = \
+                    zf, member, parts
+
+        for path, (zf, member, parts) in latest.items():
+            if manifest is not None and len(parts) > 1:
+                files = manifest.setdefault(parts[0], {})
+                files['/'.join(parts[1:])] = [member.CRC, member.file_size]
+            version = [member.CRC, member.file_size]
+            # A file without a record was extracted by an older version,
+            # and may have been fixed since
+            if os.path.exists(path) and versions.get(path, version) == version:
+                versions[path] = version
+                skipped += 1
+                continue
 
-    while len(g) == 0:
-        if msg.ask_yn('Directory names do not match, remove /submission and retry?',
-                      msgtype='warn'):
-            shutil.rmtree('submission')
-            msg.info('Extracting...')
-            z = glob.glob('CSC 116*.zip')
-            if len(z) == 1:
-                unzip(z[0])
-            g = glob.glob(f'submission/*{moodle_sub_specifier}')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with zf.open(member) as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            versions[path] = version
+            extracted += 1
+    finally:
+        for zf in archives:
+            zf.close()
+        save_extracted(versions)
+    return extracted, skipped
 
+
+# `{path: [crc, size]}` of the zip member every file was extracted from
+EXTRACTED = '.ags-extracted.json'
+
+
+def load_extracted():
+    """ Return the stored versions of the extracted files. """
+
+    try:
+        with open(EXTRACTED) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_extracted(versions):
+    """ Store the versions of the extracted files. """
+
+    with open(EXTRACTED, 'w') as f:
+        json.dump(versions, f, sort_keys=True)
+
+
+@agstrace.stage
+def rename():
+    """ Rename directories left by a previous full extraction to
+    [lastname firstname].
+    """
+
+    g = glob.glob(f'submission/*{MOODLE_SUBMISSION}')
+    if len(g) == 0:
+        return
+
+    msg.info('Renaming...')
+    save_participants({os.path.basename(e.split('__')[0]): participant(e)
+                       for e in g if participant(e)})
     for entry in g:
-        print(msg.align_left(msg.name(entry.split('/')[1]), 80))
+        msg.echo(msg.align_left(msg.name(entry.split('/')[1]), 80))
         entry_new = entry.split('__')[0]
-        shutil.move(entry, entry_new)
-        print(f'\t-> {msg.name(entry_new.split("/")[1])}')
+        if os.path.exists(entry_new):
+            util.link_tree(entry, entry_new)
+            shutil.rmtree(entry)
+        else:
+            shutil.move(entry, entry_new)
+        msg.echo(f'\t-> {msg.name(entry_new.split("/")[1])}')
 
     msg.info(f'Renamed to [lastname firstname]')
     msg.press_continue()
 
 
-def javac_all():
-    """ Compile all Java files in /src and /test, then copy to /bin. """
+# Selected student names by directory, built once per run by `students()`
+__students__ = {}
 
-    msg.info('Compiling...')
 
-    for student in glob.glob('* *'):
-        if not student.is_dir():
-            continue
-        os.chdir(student)
+def students(path='submission'):
+    """ Return the selected student directories in `path`, sorted by name.
+    The directory is only read the first time.
+    """
 
-        print(msg.name(student.name))
-        files = util.get_conf_asmt('files')
-        if files:
-            for file in files:
-                javac(file)
-        else:
-            for file in glob.glob('*.java', recursive=True):
-                javac(file)
+    if path not in __students__:
+        __students__[path] = select_students(path)
+    return [os.path.join(path, name) for name in __students__[path]]
+
+
+def select_students(path):
+    """ Return the sorted names of the students in `path` that match
+    `--student`/`--students-file` and `--from`. With `--incremental`, only
+    students whose submission changed or who have no results yet.
+    """
 
-        os.chdir('..')
+    wanted = list(args.student or [])
+    if args.studentsfile:
+        try:
+            with open(os.path.join(cwd_start, args.studentsfile)) as f:
+                wanted += [line.strip() for line in f
+                           if line.strip() and not line.startswith('#')]
+        except OSError as e:
+            msg.fatal(f'Cannot read the students file: {e}')
 
+    if wanted and all(not glob.has_magic(w) and
+                      os.path.isdir(os.path.join(path, w)) for w in wanted):
+        # Exact names, no need to list the whole class
+        names = sorted(set(wanted))
+    else:
+        names = sorted(e.name for e in os.scandir(path)
+                       if e.is_dir() and ' ' in e.name)
+        if wanted:
+            patterns = [w.lower() for w in wanted]
+            names = [n for n in names
+                     if any(fnmatch.fnmatch(n.lower(), p) for p in patterns)]
+    if args.start:
+        names = [n for n in names if n.lower() >= args.start.lower()]
+    if args.incremental and changed is not None:
+        # Also students without results, e.g. of a run that crashed
+        graded = agsdb.students()
+        names = [n for n in names if n in changed or n not in graded]
+
+    if not names:
+        msg.warn('No student selected')
+    return names
+
+
+def student_name(cwd='.'):
+    """ Return the name of the student directory `cwd`. """
+    return os.path.basename(os.path.abspath(cwd))
+
+
+@agstrace.stage
+def javac_all():
+    """ Compile all Java files in /src and /test, then copy to /bin.
+    Students are compiled concurrently by `--jobs` workers; the output of
+    each student is printed as one block in sorted order. In batch mode
+    nothing is asked, so the workers also report.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    msg.info('Compiling...')
+
+    dirs = students()
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        if msg.is_batch():
+            for block in pool.map(compile_report, dirs):
+                msg.echo(block, end='')
+        else:
+            for student, results in zip(dirs,
+                                        pool.map(compile_student, dirs)):
+                msg.echo(msg.name(student))
+                for result in results:
+                    report_javac(result, student)
+
+    agsdb.flush()
+    if not args.nocache:
+        limit = util.get_conf_glob('cache-size') or 256
+        agscache.prune(CACHE_JAVAC, limit * 1024 * 1024)
     msg.press_continue()
 
 
-def javac(file, lib='.:../../../../../lib/*'):
-    """ Compile a Java file to /bin. """
+def compile_report(student):
+    """ Compile and report a student. Return the report. """
+
+    with msg.task(emit=False) as sink:
+        msg.echo(msg.name(student))
+        for result in compile_student(student):
+            report_javac(result, student)
+    return sink.text()
+
+
+# Compile cache of the current assignment
+CACHE_JAVAC = os.path.join('.ags-cache', 'javac')
+
+
+def compile_student(student):
+    """ Compile all files of a student without printing anything.
+    Return a list of results (see `compile_file()`).
+    """
+
+    files = util.get_conf_asmt('files')
+    if not files:
+        files = sorted(os.path.basename(f)
+                       for f in glob.glob(os.path.join(student, '*.java')))
+
+    if args.resume:
+        name = student_name(student)
+        rows = [agsdb.lookup(name, 'javac', f) for f in files]
+        if files and None not in rows:
+            return [{'file': f, 'cmd': '', 'rc': row[0], 'out': '',
+                     'err': '', 'resumed': True}
+                    for f, row in zip(files, rows)]
+
+    if not args.nocache:
+        # The commands depend on --junit/--tstest, and the JVM helper
+        # reports diagnostics differently
+        mode = '\0'.join(['batch' if args.batchcompile else '',
+                          'daemon' if args.daemon else ''] +
+                         [javac_cmd(f) for f in files])
+        key = agscache.key(student, files, '.:../../../../../lib/*', mode)
+        results = agscache.get(CACHE_JAVAC, key, student)
+        if results is not None:
+            for result in results:
+                result['cached'] = True
+            return results
+
+    if args.batchcompile:
+        results = compile_batch(files, student)
+    else:
+        results = [compile_file(f, student) for f in files]
+    if not args.nocache:
+        agscache.put(CACHE_JAVAC, key, student, results)
+    return results
 
-    msg.info(f'Compiling {msg.underline(file)}...', '')
-    if not os.path.exists(file):
-        print()
-        msg.fail(f'{msg.underline(file)} does not exist', '')
-        input()
-        return -1
+
+def javac_cmd(file, lib='.:../../../../../lib/*'):
+    """ Return the command to compile a Java file. """
 
     # src
     cmd = f'javac {file}'
@@ -108,95 +411,425 @@ def javac(file, lib='.:../../../../../lib/*'):
     if file.startswith('TS_') or file.endswith('Test.java'):
         if args.junit or args.tstest:
             cmd = f'javac -cp {lib} {file}'
+    return cmd
+
+
+def compile_file(file, cwd='.', lib='.:../../../../../lib/*'):
+    """ Compile a Java file in `cwd` without printing anything.
+    Return a dict with keys `file`, `cmd`, `rc`, `out` and `err`.
+    `rc` is `None` if the file does not exist.
+    """
+
+    result = {'file': file, 'cmd': javac_cmd(file, lib),
+              'rc': None, 'out': '', 'err': ''}
+    if not os.path.exists(os.path.join(cwd, file)):
+        return result
+
+    start = time.time()
+    reply = None
+    if args.daemon:
+        cp = lib if result['cmd'].startswith('javac -cp') else '.'
+        with agstrace.span(result['cmd'], student=agstrace.student(cwd),
+                           step='javac', daemon=True) as span:
+            reply = agsdaemon.compile(cwd, cp, [file], daemon_timeout())
+            span['rc'] = reply and reply[0]
+    if reply is not None:
+        result['rc'], result['err'] = reply
+    else:
+        proc = agsrun.run(result['cmd'], cwd, compile_limits(), capture=True,
+                          step='javac')
+        for key in ('rc', 'out', 'err', 'truncated'):
+            result[key] = proc[key]
+    result['duration'] = time.time() - start
+    return result
+
+
+def daemon_timeout():
+    """ Return the seconds a JVM helper may take to compile, the timeout of
+    a run. A helper that takes longer is replaced and javac runs instead.
+    """
+    return run_limits().get('timeout')
+
+
+def compile_limits():
+    """ Return the limits of javac: only its output is cut. """
+    return {'stdin': 'null', 'output': run_limits().get('output')}
+
+
+# Header of a javac diagnostic, e.g. "Foo.java:12: error: ';' expected"
+JAVAC_DIAGNOSTIC = re.compile(r'^(.+?\.java):\d+: (error|warning): ')
+# Lines ending the last diagnostic, e.g. "2 errors" or "Note: ..."
+JAVAC_SUMMARY = re.compile(r'^(\d+ (errors?|warnings?)$|Note: )')
+
+
+def compile_batch(files, cwd='.', lib='.:../../../../../lib/*'):
+    """ Compile all files in `cwd` with a single javac process.
+    The diagnostics are mapped back to the files they belong to, so the
+    return value is a list of results in the same format and order as
+    `compile_file()` would produce.
+    """
+
+    results = [{'file': f, 'cmd': javac_cmd(f, lib),
+                'rc': None, 'out': '', 'err': ''}
+               for f in dict.fromkeys(files)]
+    existing = [r for r in results
+                if os.path.exists(os.path.join(cwd, r['file']))]
+    if not existing:
+        return results
+
+    cp = any(r['cmd'].startswith('javac -cp') for r in existing)
+    cmd = ' '.join(['javac'] + (['-cp', lib] if cp else []) +
+                   [shlex.quote(r['file']) for r in existing])
+    start = time.time()
+    reply = None
+    if args.daemon:
+        files = [r['file'] for r in existing]
+        with agstrace.span(cmd, student=agstrace.student(cwd),
+                           step='javac', daemon=True) as span:
+            reply = agsdaemon.compile(cwd, lib if cp else '.', files,
+                                      daemon_timeout())
+            span['rc'] = reply and reply[0]
+    truncated = False
+    if reply is not None:
+        (rc, err), out = reply, ''
+    else:
+        proc = agsrun.run(cmd, cwd, compile_limits(), capture=True,
+                          step='javac')
+        rc, out, err = proc['rc'], proc['out'], proc['err']
+        truncated = proc['truncated']
+
+    # Split stderr into one chunk per diagnostic
+    by_name = {os.path.normpath(r['file']): r for r in existing}
+    failed = set()
+    owner = None
+    for line in err.splitlines(keepends=True):
+        m = JAVAC_DIAGNOSTIC.match(line)
+        if m:
+            owner = by_name.get(os.path.normpath(m.group(1)))
+            if owner is not None and m.group(2) == 'error':
+                failed.add(owner['file'])
+        elif JAVAC_SUMMARY.match(line):
+            owner = None
+        if owner is not None:
+            owner['err'] += line
+
+    duration = time.time() - start
+    for r in existing:
+        r['cmd'] = cmd
+        r['duration'] = duration / len(existing)
+        r['out'] = out
+        r['rc'] = 1 if r['file'] in failed else 0
+        r['truncated'] = truncated
+    if rc != 0:
+        # javac writes no class files at all when any file has errors, and
+        # some errors cannot be attributed (e.g. in a dependency, or in
+        # elided output): the other files are compiled one by one
+        for r in existing:
+            if r['file'] not in failed:
+                r.update(compile_file(r['file'], cwd, lib))
+    return results
+
+
+def report_javac(result, cwd='.', lib='.:../../../../../lib/*', attempt=0):
+    """ Print the result of `compile_file()` and ask for retry on failure.
+    Return the exit code of the last attempt.
+    """
 
-    proc = sp.Popen(cmd, shell=True,
-                    stdout=sp.PIPE, stderr=sp.PIPE)
-    out, err = proc.communicate()
-    rc = proc.wait()
-    out = out.decode(encoding='utf-8')
-    err = err.decode(encoding='utf-8')
+    file = result['file']
+    msg.info(f'Compiling {msg.underline(file)}...', '')
+    if result.get('resumed'):
+        msg.echo(f'skipped (recorded exit code {result["rc"]})')
+        return result['rc']
+    if result['rc'] is None:
+        agsdb.record(student_name(cwd), 'javac', file, -1)
+        msg.echo()
+        msg.fail(f'{msg.underline(file)} does not exist', '')
+        msg.review(f'{msg.name(student_name(cwd))} {file} does not exist')
+        msg.pause()
+        return -1
+
+    out, err, rc = result['out'], result['err'], result['rc']
+    agsdb.record(student_name(cwd), 'javac', file, rc,
+                 result.get('duration'), out, err,
+                 truncated=result.get('truncated'))
     if not args.nostacktrace:
         if len(out) > 0:
-            print()
+            msg.echo()
             msg.info(f'Output:\n{out}')
         if len(err) > 0:
-            print()
+            msg.echo()
             msg.fail(f'Error:\n{err}')
 
     if rc != 0:
-        print()
-        msg.fail(f'Failed to compile by {msg.underline(cmd)}')
-        sp.Popen([default_open, file])
-        if msg.ask_retry():
-            javac(file)
+        msg.echo()
+        msg.fail(f'Failed to compile by {msg.underline(result["cmd"])}')
+        open_file(file, cwd)
+        if msg.ask_retry(attempt):
+            return javac(file, lib, cwd, attempt + 1)
+        msg.review(f'{msg.name(student_name(cwd))} {file} does not compile')
+    elif result.get('cached'):
+        msg.echo('done (cached)')
     else:
-        print('done')
+        msg.echo('done')
     return rc
 
 
-def java(file, arg='', arg2=''):
+def javac(file, lib='.:../../../../../lib/*', cwd='.', attempt=0):
+    """ Compile a Java file to /bin.
+    If the file was already compiled by `compile_batch()` for the current
+    student, only its result is reported.
+    """
+
+    if file in compiled:
+        return report_javac(compiled.pop(file), cwd, lib, attempt)
+    return report_javac(compile_file(file, cwd, lib), cwd, lib, attempt)
+
+
+def open_file(file, cwd='.'):
+    """ Open a file with the default program (not in batch mode). """
+    if not msg.is_batch():
+        sp.Popen([default_open, file], cwd=cwd)
+
+
+# Results of `compile_batch()` for the current student, not reported yet
+compiled = {}
+
+
+def record_tests(name, cmd, cwd, result):
+    """ Record the tests of `cmd`, run in `cwd`, if it runs JUnit. Return
+    the passed and run tests as keyword arguments of `agsdb.record()`.
+    """
+
+    junit = agsjunit.split(cmd)
+    if junit is None:
+        return {}
+    classes, events = junit
+    cls = ' '.join(classes)
+    counts, tests = agsjunit.results(
+        result['out'], cls, events and os.path.join(cwd, events),
+        result.get('duration'))
+    agsdb.record_tests(name, cls, tests)
+    return counts
+
+
+def java(file, arg='', arg2='', cp='.:*', attempt=0):
     """ Run a compiled Java program. """
     # TODO: Refactor
 
     msg.info(f'Running {file}...')
-    cmd = f'java -cp ".:*" {arg} {file.replace(".java", "")} {arg2}'
-    if os.system(cmd) != 0:
+    cls = file.replace('.java', '')
+    if args.resume and agsdb.lookup(student_name(), 'java', cls):
+        msg.info(f'{msg.underline(cls)} already recorded, skipping')
+        return
+
+    limits = run_limits()
+    junit = arg == agsjunit.JUNITCORE
+    log = output_log('.', 'java', cls)
+    if junit:
+        cmd = agsjunit.command(cp, f'{cls} {arg2}',
+                               agsjunit.events_file(log))
+        agsjunit.prepare(cmd)
+    else:
+        cmd = f'java -cp "{cp}" {arg} {cls} {arg2}'
+    result = agsrun.run(cmd, limits_=limits, capture=junit, step='java',
+                        log=log)
+    rc = result['rc']
+    counts = {}
+    if junit:
+        msg.echo(result['out'] + result['err'], end='')
+        counts = record_tests(student_name(), cmd, '.', result)
+    agsdb.record(student_name(), 'java', cls, rc, result['duration'],
+                 truncated=result['truncated'], **counts)
+    if result['timeout']:
+        msg.fail(f'Killed after {limits["timeout"]}s')
+    if rc != 0:
         msg.fail(f'Failed to run by {msg.underline(" ".join(cmd.split()))}')
-        if msg.ask_retry():
-            java(file)
+        if msg.ask_retry(attempt):
+            java(file, arg, arg2, cp, attempt + 1)
+        else:
+            msg.review(f'{msg.name(student_name())} {cls} failed')
 
 
+@agstrace.stage
 def java_all():
     """ Run all Java classes. """
 
     msg.info('Running...')
-    for student in sorted(os.scandir('.'), key=lambda s: s.name):
-        if not student.is_dir():
-            continue
-
-        print(msg.name(student.name))
-        os.chdir(student.name)
-
-        cmds = util.get_conf_asmt('custom run')
-        files = util.get_conf_asmt('files')
-
-        if cmds:
-            run_custom(cmds)
-        elif files:
-            for f in files:
-                java(f)
-        else:
-            for f in glob.glob('*.java'):
-                java(f)
-
-        os.chdir('..')
+    table = []
+    for student in students():
+        msg.echo(msg.name(student))
+        os.chdir(student)
+        table.extend(java_student())
+        os.chdir(os.path.join('..', '..'))
+    agsdb.flush()
+
+    if table:
+        print_output_table(table)
+
+
+def java_student():
+    """ Run the classes of the student in the current directory.
+    Return the rows of the output table (see `print_output_table()`).
+    """
+
+    expected = util.get_conf_asmt('expected')
+    cmds = util.get_conf_asmt('custom run')
+    files = util.get_conf_asmt('files')
+
+    table = []
+    if expected:
+        for cls, spec in expected.items():
+            table.append((student_name(), cls) + java_output(cls, spec))
+    elif cmds:
+        run_custom(cmds)
+    elif files:
+        for f in files:
+            java(f)
+    else:
+        for f in glob.glob('*.java'):
+            java(f)
+    return table
+
+
+def java_output(cls, spec):
+    """ Run a class with the `input` and `args` of `spec`, and compare its
+    output with the `output` file of `spec`, ignoring whitespace.
+    Return `(status, similarity)`.
+    """
+
+    msg.info(f'Running {cls}...', '')
+    limits = run_limits()
+    limits['stdin'] = spec.get('input', 'null')
+    cmd = f'java -cp ".:*" {cls} {spec.get("args", "")}'
+    result = agsrun.run(cmd, limits_=limits, capture=True, step='output',
+                        log=output_log('.', 'output', cls))
+
+    if result['timeout']:
+        status, score = 'TIMEOUT', 0.0
+    elif result['rc'] != 0:
+        status, score = 'FAIL', 0.0
+    else:
+        try:
+            score, diff = util.compare_output(result['out'], spec['output'])
+            status = 'PASS' if score == 1.0 else 'DIFF'
+        except OSError as e:
+            msg.fail(f'Cannot read expected output: {e}')
+            status, score = 'FAIL', 0.0
+    agsdb.record(student_name(), 'output', cls, result['rc'],
+                 result['duration'], result['out'], result['err'],
+                 count=int(score * 100), truncated=result['truncated'])
+
+    msg.echo(f'{status} ({score:.1%})')
+    if status == 'DIFF' and not args.nostacktrace:
+        msg.echo(diff, end='')
+    elif status == 'FAIL' and not args.nostacktrace:
+        msg.fail(f'Error:\n{result["err"]}')
+    if status != 'PASS':
+        msg.review(f'{msg.name(student_name())} {cls} {status}')
+    return status, score
+
+
+def print_output_table(table):
+    """ Print `(student, class, status, similarity)` rows. """
+
+    msg.info('Output summary')
+    width = max(len(msg.name(student)) for student, *_ in table) + 2
+    for student, cls, status, score in table:
+        color = msg.style.color.green if status == 'PASS' \
+            else msg.style.color.red
+        msg.echo(f'{msg.align_left(msg.name(student), width)}'
+                 f'{msg.align_left(cls, 24)}'
+                 f'{msg.style.stylize(color, msg.align_left(status, 8))}'
+                 f'{score:>7.1%}')
+    passed = sum(1 for row in table if row[2] == 'PASS')
+    msg.info(f'{passed}/{len(table)} passed')
+
+
+@agstrace.stage
+def similarity():
+    """ Print the most similar pairs of submissions, also with the saved
+    indexes of `--similarity-index` (see `agssim`).
+    """
+
+    import agssim
+
+    msg.info('Comparing submissions...')
+    docs = {}
+    for student in students():
+        files = [f for f in sorted(glob.glob(os.path.join(student, '*.java')))
+                 if not os.path.basename(f).startswith('TS_')]
+        docs[student_name(student)] = agssim.fingerprint_files(files)
+
+    past = {}
+    for path in args.simindex or []:
+        try:
+            past.update(agssim.load(os.path.join(cwd_start, path)))
+        except (OSError, ValueError) as e:
+            msg.warn(f'Cannot load similarity index: {e}')
+    if args.simsave:
+        path = os.path.join(cwd_start, args.simsave)
+        label = f'{util.current_semester()} {asmt_name}{asmt_num}'
+        agssim.save(path, {f'{label}/{name}': hashes
+                           for name, hashes in docs.items()})
+        msg.info(f'Similarity index written to {msg.underline(path)}')
+
+    pairs = agssim.pairs(docs, past, args.similarity or 20)
+    if not pairs:
+        msg.info('No similar submissions')
+        return
+    msg.info(f'Most similar {len(pairs)} pair(s)')
+    width = max(len(msg.name(name)) for pair in pairs for name in pair[:2])
+    for name, other, shared, share, other_share in pairs:
+        other = other if other in docs else f'{other} (saved)'
+        msg.echo(f'  {msg.align_left(msg.name(name), width + 2)}'
+                 f'{share:>6.1%}  '
+                 f'{msg.align_left(msg.name(other), width + 10)}'
+                 f'{other_share:>6.1%}  {shared} fingerprint(s)')
 
 
+@agstrace.stage
 def ts_test():
     """ Run all teaching staff tests. """
 
+    import zipfile
+
     msg.info('Running teaching staff tests...')
     with zipfile.ZipFile(args.tstest) as zf:
         msg.info(f'Extracting {args.tstest}...')
         zf.extractall('ts')
 
     ts_path = os.path.abspath('ts')
-    os.chdir('submission')
+    ts_bin = os.path.abspath('ts-bin')
+    shutil.rmtree(ts_bin, ignore_errors=True)
+    if args.parallel:
+        ts_test_parallel(ts_path, ts_bin)
+        return
 
-    for student in sorted(glob.glob('* *')):
+    for student in students():
         os.chdir(student)
-        print(msg.name(student))
+        msg.echo(msg.name(student))
 
         msg.info('Copying TS files...')
-        distutils.dir_util.copy_tree(ts_path, '.')
+        util.link_tree(ts_path, '.', args.tslink)
 
         src = util.get_conf_asmt('src')
         for f in src:
-            msg.info(f'Opening {msg.underline(f)}...')
-            sp.Popen([default_open, f])
+            if not msg.is_batch():
+                msg.info(f'Opening {msg.underline(f)}...')
+            open_file(f)
 
         test = util.get_conf_asmt('test')
 
+        shared = precompile_ts(ts_path, ts_bin) if args.tsprecompile else None
+
+        compiled.clear()
+        if args.batchcompile:
+            files = src + test
+            if shared is None:
+                files += sorted(glob.glob('TS_*.java'))
+            for result in compile_batch(files, lib='.:*'):
+                compiled[result['file']] = result
+
         for item in util.get_conf_asmt('order'):
             # Custom run is a dict: {'custom run' : [..., ...]}
             if type(item) is dict:
@@ -211,9 +844,9 @@ def ts_test():
             if _item == 'wce':
                 ts_wce()
             elif _item == 'tsbbt':
-                ts_tsbbt()
+                ts_tsbbt(shared)
             elif _item == 'tswbt':
-                ts_tswbt()
+                ts_tswbt(shared)
             elif _item == 'bbt':
                 ts_bbt()
             elif _item == 'wbt':
@@ -223,12 +856,181 @@ def ts_test():
                 if cs == 0:
                     msg.info('No checkstyle error found')
                 else:
-                    msg.textbar('Total')
-                    print(msg.align_right(cs, 3))
+                    msg.textbar('Total', cs)
 
+        agsdb.flush()
         msg.info('Testing done')
         msg.press_continue()
-        os.chdir('..')
+        os.chdir(os.path.join('..', '..'))
+
+
+def ts_test_parallel(ts_path, ts_bin):
+    """ Run the `order` of every student as concurrent tasks.\n
+    Steps of a student run in order, as they share its directory and class
+    files, except `style`, which only reads sources and overlaps with the
+    rest. Students are independent, and at most `--jobs` steps run at once.
+    Output goes to .ags-logs/[student]/ instead of the terminal.
+    """
+
+    import agssched
+
+    src = util.get_conf_asmt('src') or []
+    test = util.get_conf_asmt('test') or []
+    order = util.get_conf_asmt('order')
+    limits = run_limits()
+
+    tasks = {}
+    for student in students():
+        util.link_tree(ts_path, student, args.tslink)
+        shared = precompile_ts(ts_path, ts_bin, student) \
+            if args.tsprecompile else None
+        previous = None
+        for i, item in enumerate(order):
+            step = next(iter(item)) if type(item) is dict else item.lower()
+            key = (student_name(student), f'{i + 1}.{step}')
+            if step in ('style', 'checkstyle'):
+                tasks[key] = ([], style_task(student, src, test))
+                continue
+            if step == 'bbt':
+                function = bbt_task(student)
+            else:
+                log = os.path.join('.ags-logs', key[0], f'{key[1]}.log')
+                if type(item) is dict:
+                    function = commands_task(student, 'custom',
+                                             item.get(step), limits, log)
+                else:
+                    cmds = step_commands(step, student, src, test, shared)
+                    function = commands_task(student, step, cmds, limits,
+                                             log)
+            tasks[key] = ([previous] if previous else [], function)
+            previous = key
+
+    def report(key, rc, detail, duration, done, total):
+        status = 'ok' if rc == 0 else 'skipped' if rc is None else 'FAIL'
+        color = msg.style.color.green if rc == 0 else msg.style.color.red
+        msg.echo(f'({done}/{total}) {msg.name(key[0])} {key[1]}: '
+                 f'{msg.style.stylize(color, status)} {detail} '
+                 f'({duration:.1f}s)', flush=True)
+
+    msg.info(f'Running {len(tasks)} tasks with {args.jobs} job(s)...')
+    results = agssched.run(tasks, args.jobs, report)
+    agsdb.flush()
+    print_task_table(results)
+
+
+def step_commands(step, cwd, src, test, shared=None):
+    """ Return the shell commands of a step in `order`. """
+
+    cp = f'{shared}:.:*' if shared else '.:*'
+
+    def java_class(f):
+        return os.path.splitext(f)[0]
+
+    def junit(f):
+        events = agsjunit.events_file(output_log(cwd, step, java_class(f)))
+        return agsjunit.command(cp, java_class(f), os.path.abspath(events))
+
+    def javac_all_of(files):
+        return [f'javac -cp "{cp}" ' + ' '.join(shlex.quote(f) for f in files)]
+
+    def ts_files(pattern):
+        return sorted(os.path.basename(f)
+                      for f in glob.glob(os.path.join(cwd, pattern)))
+
+    def compile_ts(files):
+        # Precompiled TS classes link against the classes of the student,
+        # which have to be compiled like `compile_stale()` does
+        if shared:
+            return javac_all_of(src) if src else []
+        return javac_all_of(files)
+
+    if step == 'wce':
+        arg2 = args.argument or ''
+        return javac_all_of(src + test) + \
+            [f'java -cp "{cp}" {java_class(f)} {arg2}' for f in src] + \
+            [junit(f) for f in test]
+    if step == 'tsbbt':
+        tests = ts_files('TS_*_BB_Test.java')
+        return compile_ts(tests) + [junit(f) for f in tests]
+    if step == 'tswbt':
+        runners = ts_files('TS_*_WB_Runner.java')[:1]
+        return compile_ts(runners) + \
+            [f'java -cp "{cp}" {java_class(f)}' for f in runners]
+    if step == 'wbt':
+        return javac_all_of(test) + \
+            [junit(f) for f in test]
+    msg.warn(f'Unknown step {msg.underline(step)}')
+    return []
+
+
+def commands_task(cwd, step, cmds, limits, log):
+    """ Return a task running `cmds` one after another in `cwd`. The
+    output is written to `log`. The exit code is the first non-zero one.
+    """
+
+    async def task():
+        name = student_name(cwd)
+        os.makedirs(os.path.dirname(log), exist_ok=True)
+        rc = 0
+        with open(log, 'w') as f:
+            for n, c in enumerate(cmds):
+                full = f'{os.path.splitext(log)[0]}.{n}.full.log'
+                agsjunit.prepare(c, cwd)
+                result = await agsrun.run_async(c, cwd, limits, step, full)
+                f.write(f'$ {c}\n{result["out"]}{result["err"]}')
+                if result['timeout']:
+                    f.write(f'Killed after {limits["timeout"]}s\n')
+                counts = record_tests(name, c, cwd, result)
+                agsdb.record(name, step, c, result['rc'], result['duration'],
+                             result['out'], result['err'],
+                             truncated=result['truncated'], **counts)
+                rc = rc or result['rc']
+        if rc != 0:
+            msg.review(f'{msg.name(name)} {step} failed, see {log}')
+        return rc, f'{len(cmds)} command(s)'
+    return task
+
+
+def style_task(cwd, src, test):
+    """ Return a task counting the checkstyle violations in `cwd`. """
+
+    async def task():
+        import asyncio
+        loop = asyncio.get_event_loop()
+        counts = await loop.run_in_executor(None, checkstyle_counts,
+                                            [cwd], src, test)
+        total = sum(num or 0 for _, num in counts[cwd])
+        failed = any(num is None and os.path.exists(os.path.join(cwd, f))
+                     for f, num in counts[cwd])
+        if failed:
+            return 1, 'checkstyle failed'
+        return 0, f'{total} violation(s)'
+    return task
+
+
+def bbt_task(cwd):
+    """ Return a task skipping black box testing, which needs a grader. """
+
+    async def task():
+        msg.review(f'{msg.name(student_name(cwd))} black box testing skipped')
+        return None, 'needs a grader'
+    return task
+
+
+def print_task_table(results):
+    """ Print the status of every step of every student. """
+
+    steps = list(dict.fromkeys(step for _, step in results))
+    names = sorted({name for name, _ in results})
+    width = max(len(msg.name(name)) for name in names) + 2
+    msg.echo(' ' * width + ''.join(msg.align_left(s, 14) for s in steps))
+    for name in names:
+        row = msg.align_left(msg.name(name), width)
+        for step in steps:
+            rc, _ = results.get((name, step), (None, ''))
+            status = 'ok' if rc == 0 else '-' if rc is None else 'FAIL'
+            row += msg.align_left(status, 14)
+        msg.echo(row)
 
 
 def ts_wce():
@@ -246,27 +1048,133 @@ def ts_wce():
     msg.press_continue()
 
 
-def ts_tsbbt():
+def ts_tsbbt(shared=None):
     msg.info('Compiling TS_BBT...')
+    cp = '.:*'
+    if shared:
+        compile_stale(util.get_conf_asmt('src'))
+        cp = f'{shared}:.:*'
     for f in sorted(glob.glob('TS_*_BB_Test.java')):
-        javac(f, '.:*')
-        java(f, arg='org.junit.runner.JUnitCore')
+        if not shared:
+            javac(f, cp)
+        java(f, arg='org.junit.runner.JUnitCore', cp=cp)
     msg.press_continue()
 
 
-def ts_tswbt():
+def ts_tswbt(shared=None):
     msg.info('Compiling TS_WBT...')
+    cp = '.:*'
+    if shared:
+        compile_stale(util.get_conf_asmt('src'))
+        cp = f'{shared}:.:*'
     ts = glob.glob('TS_*_WB_Runner.java')
-    javac(ts[0], '.:*')
-    java(ts[0])
+    if not shared:
+        javac(ts[0], cp)
+    java(ts[0], cp=cp)
     msg.press_continue()
 
 
+def precompile_ts(ts_path, ts_bin, cwd='.'):
+    """ Compile the TS_*.java files once per distinct student API (see
+    `api_signature()`) into a subdirectory of `ts_bin`.
+    Return that directory, or `None` if the TS files do not compile against
+    the student in `cwd`, who then compiles them as before.
+    """
+
+    files = sorted(glob.glob(os.path.join(ts_path, 'TS_*.java')))
+    if not files:
+        return None
+    out = os.path.join(ts_bin, api_signature(cwd))
+    if os.path.isdir(out):
+        return out
+
+    os.makedirs(ts_bin, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=ts_bin, prefix='.tmp-')
+    # Student sources are only read for their API; their classes must not
+    # end up in the shared directory.
+    with agstrace.span('javac -implicit:none', student=agstrace.student(cwd),
+                       step='tsprecompile') as span:
+        proc = sp.run(['javac', '-implicit:none', '-cp', '.:*', '-d', tmp]
+                      + files, cwd=cwd, stdout=sp.PIPE, stderr=sp.PIPE)
+        span['rc'] = proc.returncode
+    if proc.returncode != 0:
+        shutil.rmtree(tmp, ignore_errors=True)
+        msg.warn('TS files do not compile against this student, '
+                 'compiling them per student')
+        return None
+    for cls in glob.glob(os.path.join(tmp, '**', '*.class'), recursive=True):
+        if not os.path.basename(cls).startswith('TS_'):
+            os.remove(cls)
+
+    try:
+        os.rename(tmp, out)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+    sig = os.path.basename(out)
+    msg.info(f'Compiled TS files for API {msg.underline(sig)}')
+    return out
+
+
+# Comments, string/char literals, braces and semicolons, everything else
+JAVA_TOKEN = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"'
+                        r"|'(?:\\.|[^'\\\n])*'|[{};]|[^{};\"'/]+|/", re.S)
+
+
+def api_signature(path='.'):
+    """ Return a short hash of the top-level and member declarations of all
+    student sources in `path` (private members excluded). Classes compiled
+    against one student link against every student with the same hash.
+    Field initializers are part of a declaration, so constants inlined by
+    javac match as well.
+    """
+
+    h = hashlib.sha256()
+    for f in sorted(glob.glob(os.path.join(path, '*.java'))):
+        name = os.path.basename(f)
+        if name.startswith('TS_'):
+            continue
+        with open(f, encoding='utf-8', errors='replace') as src:
+            code = src.read()
+        h.update(name.encode())
+
+        depth, decl = 0, []
+        for tok in JAVA_TOKEN.findall(code):
+            if tok.startswith('//') or tok.startswith('/*'):
+                continue
+            if tok in ('{', ';') and depth <= 1:
+                text = ' '.join(''.join(decl).split())
+                if text and 'private' not in text.split('(')[0].split():
+                    h.update(f'\0{depth}\0{text}'.encode())
+                decl = []
+            if tok == '{':
+                depth += 1
+            elif tok == '}':
+                depth -= 1
+            elif depth <= 1 and tok != ';':
+                decl.append(tok)
+    return h.hexdigest()[:16]
+
+
+def compile_stale(files, lib='.:*'):
+    """ Compile the files whose class file is missing or outdated. """
+
+    for f in files:
+        cls = f'{os.path.splitext(f)[0]}.class'
+        if not os.path.exists(cls) or \
+                os.path.getmtime(cls) < os.path.getmtime(f):
+            javac(f, lib)
+
+
 def ts_bbt():
+    if msg.is_batch():
+        msg.warn('Black box testing needs a grader, skipping')
+        msg.review(f'{msg.name(student_name())} black box testing skipped')
+        return
+
     pdf = glob.glob('*.pdf')
     if len(pdf) != 1:
         msg.fail('BBTP pdf file not found')
-        input()
+        msg.pause()
         return
 
     msg.info(f'Opening {pdf[0]}...')
@@ -294,89 +1202,529 @@ def ts_wbt(test):
 
 
 def checkstyle(src, test, cs='~/cs-checkstyle/checkstyle'):
+    """ Print the number of checkstyle violations per file of the current
+    student. Return the total.
+    """
+
+    return print_checkstyle(checkstyle_counts(['.'], src, test, cs)['.'])
+
+
+def print_checkstyle(counts):
+    """ Print the `(file, count)` pairs of a student. Return the total. """
+
     total = 0
-    for f in src:
-        msg.textbar(f)
-        cmd = f'{cs} {f} | grep -c ""'
-        proc = sp.run(cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE)
-        num = int(proc.stdout) - 4
-        total += num
-        print(msg.align_right(num, 3))
-    # Ignore magic numbers for test files
-    for f in test:
-        msg.textbar(f)
-        cmd = f'{cs} {f} | grep -v "is a magic number" -c'
-        proc = sp.run(cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE)
-        num = int(proc.stdout) - 4
+    for f, num in counts:
+        if num is None:
+            msg.textbar(f, '-')
+            continue
         total += num
-        print(msg.align_right(num, 3))
+        msg.textbar(f, num)
     return total
 
 
+@agstrace.stage
 def checkstyle_all():
-    for student in sorted(os.scandir('.'), key=lambda s: s.name):
-        if not student.is_dir():
-            continue
-        os.chdir(student.name)
-        print(msg.name(student.name, swap=True))
-
-        src = util.get_conf_asmt('src')
-        test = util.get_conf_asmt('test')
-        total = checkstyle(src, test)
-        print('-' * 30)
-        msg.textbar('Total')
-        print(msg.align_right(total, 3))
+    src = util.get_conf_asmt('src')
+    test = util.get_conf_asmt('test')
+    dirs = students()
+    counts = checkstyle_counts(dirs, src, test)
+
+    for student in dirs:
+        msg.echo(msg.name(student, swap=True))
+        total = print_checkstyle(counts[student])
+        msg.echo('-' * 30)
+        msg.textbar('Total', total)
+        msg.echo()
+
+
+# A violation in the plain format, with or without the severity, e.g.
+# "[WARN] /path/Foo.java:12:5: '{' is not preceded with whitespace. [...]"
+CHECKSTYLE_VIOLATION = re.compile(r'^(?:\[\w+\] )?(.+?\.java):\d+(?::\d+)?: ')
+
+
+def checkstyle_counts(dirs, src, test, cs='~/cs-checkstyle/checkstyle'):
+    """ Count the checkstyle violations of `src` and `test` files in every
+    directory of `dirs`, ignoring magic numbers in test files.
+    The directories are split into `--jobs` shards and each shard is checked
+    by a single checkstyle process.
+    Return `{dir: [(file, count)]}`, where count is `None` for missing files
+    and for files checkstyle failed to check (recorded with exit code 1).
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    targets = [(f, False) for f in src] + [(f, True) for f in test]
+    counts = {d: [] for d in dirs}
+    paths = {d: [] for d in dirs}
+    files = {}
+    for d in dirs:
+        name = student_name(d)
+        for f, is_test in targets:
+            path = os.path.abspath(os.path.join(d, f))
+            row = agsdb.lookup(name, 'checkstyle', f) if args.resume else None
+            if row and row[0] == 0:
+                counts[d].append([f, row[1]])
+                continue
+            exists = os.path.exists(path)
+            counts[d].append([f, 0 if exists else None])
+            if exists:
+                paths[d].append(path)
+                files[path] = (counts[d][-1], is_test)
+
+    shards = [[p for d in dirs[i::args.jobs] for p in paths[d]]
+              for i in range(args.jobs)]
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        shards = [shard for shard in shards if shard]
+        outputs = pool.map(lambda shard: run_checkstyle(shard, cs), shards)
+        for shard, (output, error) in zip(shards, outputs):
+            if error is not None:
+                msg.fail(f'checkstyle failed: {error}')
+                for path in shard:
+                    files[path][0][1] = None
+                continue
+            for line in output.splitlines():
+                m = CHECKSTYLE_VIOLATION.match(line)
+                if not m:
+                    continue
+                entry = files.get(os.path.abspath(m.group(1)))
+                if entry is None:
+                    continue
+                count, is_test = entry
+                if is_test and 'is a magic number' in line:
+                    continue
+                count[1] += 1
+
+    for path, (count, _) in files.items():
+        name = student_name(os.path.dirname(path))
+        failed = count[1] is None
+        agsdb.record(name, 'checkstyle', count[0], 1 if failed else 0,
+                     count=count[1])
+        if failed:
+            msg.review(f'{msg.name(name)} checkstyle failed on {count[0]}')
+    agsdb.flush()
+    return {d: [tuple(c) for c in counts[d]] for d in dirs}
+
+
+def run_checkstyle(files, cs='~/cs-checkstyle/checkstyle'):
+    """ Run checkstyle once on all `files`. Return `(output, error)`, where
+    `error` is `None` unless checkstyle could not run, e.g. the script is
+    missing (exit code 126/127) or it only wrote errors.
+    """
+
+    cmd = ' '.join([cs] + [shlex.quote(f) for f in files])
+    with agstrace.span(f'{cs} ({len(files)} files)',
+                       step='checkstyle') as span:
+        proc = sp.run(cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE)
+        span.update(rc=proc.returncode, bytes=len(proc.stdout))
+    out = proc.stdout.decode(encoding='utf-8', errors='replace')
+    err = proc.stderr.decode(encoding='utf-8', errors='replace').strip()
+    # Checkstyle exits with the number of violations, so only a missing
+    # command or errors without any audit output count as a failure
+    audited = any(CHECKSTYLE_VIOLATION.match(line) or 'audit' in line.lower()
+                  for line in out.splitlines())
+    if proc.returncode in (126, 127) or (err and not audited):
+        lines = err.splitlines()
+        return out, lines[0] if lines else f'exit code {proc.returncode}'
+    return out, None
+
+
+@agstrace.stage
+def hw():
+    """ Review the homework of every student. All submissions are indexed
+    first; the next `--prefetch` ones are prepared (see `agsreview`) in the
+    background while the grader reads the current one.
+    """
 
-        print()
-        os.chdir('..')
+    from concurrent.futures import ThreadPoolExecutor
 
+    import agsreview
 
-def hw():
     msg.info('Checking homework...')
-    folders = glob.glob('* *')
-    for f in folders:
-        print(msg.name(f))
-        os.chdir(f)
-
-        files = glob.glob('*.*')
-        num = len(files)
-        if num == 0:
-            msg.fail('No submission')
-        elif num == 1:
-            pdf = files[0]
-            msg.info(f'Opening {msg.underline(pdf)}...')
-            sp.Popen(f'{default_open} \"{pdf}\"', shell=True)
-        else:
-            msg.warn(f'Multiple files found (total {num}):')
-            msg.index_list(files)
-            print('Select a file to open: ', end='')
-            i = msg.ask_index(0, num)
-            if 0 < i < num:
-                pdf = files[i]
-                msg.info(f'Opening {msg.underline(pdf)}...')
-                sp.Popen(f'{default_open} \"{pdf}\"', shell=True)
+    names = students()
+    if not names:
+        msg.fail('No submission')
+        return
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        submissions = list(pool.map(agsreview.index, names))
+    print_hw_table(names, submissions)
+    for f, submission in zip(names, submissions):
+        files = [file['name'] for file in submission['files']]
+        agsdb.record(student_name(f), 'hw', ', '.join(files),
+                     0 if files else 1, count=len(files))
+        # Batch mode lists every submission, to be opened later
+        detail = (files if msg.is_batch() else []) + submission['flags']
+        if detail:
+            msg.review(f'{msg.name(f)} {", ".join(detail)}')
+    agsdb.flush()
+    if msg.is_batch():
+        return
 
-        input()
-        os.chdir('..')
+    cache = '.ags-review'
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        prepared = {}
+        for i, (f, submission) in enumerate(zip(names, submissions)):
+            for j in range(i, min(i + 1 + args.prefetch, len(names))):
+                if j not in prepared:
+                    prepared[j] = pool.submit(
+                        agsreview.prepare, submissions[j],
+                        os.path.join(cache, student_name(names[j])))
+            paths = prepared.pop(i).result()
+            msg.echo(msg.name(f))
+            hw_open(submission, paths)
+            msg.pause()
+
+
+def hw_open(submission, paths):
+    """ Open the submission, asking which file if there are several. """
+
+    files = [f['name'] for f in submission['files']]
+    num = len(files)
+    if num == 0:
+        msg.fail('No submission')
+        return
+    i = 0
+    if num > 1:
+        msg.warn(f'Multiple files found (total {num}):')
+        msg.index_list(files)
+        msg.echo('Select a file to open: ', end='')
+        i = msg.ask_index(0, num)
+    if 0 <= i < num:
+        path = paths[files[i]]
+        msg.info(f'Opening {msg.underline(os.path.basename(path))}...')
+        msg.flush()
+        sp.Popen(f'{default_open} {shlex.quote(path)}', shell=True)
+
+
+def print_hw_table(names, submissions):
+    """ Print the files, size, type, pages and flags of every submission.
+    """
+
+    msg.info('Homework summary')
+    width = max(len(msg.name(student_name(f))) for f in names) + 2
+    for f, submission in zip(names, submissions):
+        files = submission['files']
+        types = ','.join(sorted({file['type'] for file in files})) or '-'
+        pages = sum(file['pages'] or 0 for file in files)
+        size = sum(file['size'] for file in files)
+        flags = ', '.join(submission['flags'])
+        line = f'{msg.align_left(msg.name(student_name(f)), width)}' \
+            f'{len(files):3} file(s){size / 1024:9.0f} KiB  ' \
+            f'{msg.align_left(types, 10)}{pages or "-":>4} page(s)  '
+        color = msg.style.color.yellow if flags else msg.style.color.green
+        msg.echo(line + msg.style.stylize(color, flags or 'ok'))
+    flagged = sum(1 for s in submissions if s['flags'])
+    msg.info(f'{len(submissions)} submission(s), {flagged} flagged')
 
 
 def run_custom(cmds):
     for c in cmds:
+        if args.resume and agsdb.lookup(student_name(), 'custom', c):
+            msg.info(f'{msg.underline(c)} already recorded, skipping')
+            continue
         msg.info(f'Running {msg.underline(c)}')
-        while sp.call(c, shell=True) != 0:
-            print()
+        attempt = 0
+        limits = run_limits()
+        junit = agsjunit.split(c) is not None
+        while True:
+            agsjunit.prepare(c)
+            result = agsrun.run(c, limits_=limits, capture=junit,
+                                step='custom',
+                                log=output_log('.', 'custom', c))
+            rc = result['rc']
+            counts = {}
+            if junit:
+                msg.echo(result['out'] + result['err'], end='')
+                counts = record_tests(student_name(), c, '.', result)
+            agsdb.record(student_name(), 'custom', c, rc, result['duration'],
+                         truncated=result['truncated'], **counts)
+            if result['timeout']:
+                msg.fail(f'Killed after {limits["timeout"]}s')
+            if rc == 0:
+                break
+            msg.echo()
             msg.fail(f'Failed to run {msg.underline(c)}')
-            if not msg.ask_retry():
-                print()
+            if not msg.ask_retry(attempt):
+                msg.review(f'{msg.name(student_name())} {c} failed')
+                msg.echo()
                 break
+            attempt += 1
         # msg.press_continue()
 
 
-if __name__ == '__main__':
-    if sys.hexversion < 0x03060000:
-        print('Python version >= 3.6 is required')
-        exit(1)
-    os.chdir(os.path.dirname(__file__))
+def output_log(cwd, step, target):
+    """ Return the file for the complete output of a program of the student
+    in `cwd`: .ags-logs/[student]/[step].[target].log.
+    """
+
+    target = re.sub(r'[^\w.-]+', '_', target)[:60]
+    return os.path.normpath(os.path.join(cwd, '..', '..', '.ags-logs',
+                                         student_name(cwd),
+                                         f'{step}.{target}.log'))
+
+
+def run_limits():
+    """ Return the limits for student programs (see `agsrun`). In batch
+    mode, stdin is empty unless configured otherwise.
+    """
+
+    limits = agsrun.limits({'stdin': 'null'} if msg.is_batch() else None,
+                           util.get_conf_glob('limits'),
+                           util.get_conf_asmt('limits'))
+    if args.timeout is not None:
+        limits['timeout'] = args.timeout
+    return limits
+
+
+# Options a distributed worker takes over from the coordinator
+DIST_ARGS = ['argument', 'batchcompile', 'junit', 'nocache', 'nostacktrace',
+             'timeout']
+
+
+@agstrace.stage
+def dist_serve(address):
+    """ Hand out the checkstyle, compile and run steps of every student to
+    workers (see agsdist). Results go into the database as usual.
+    """
+
+    import secrets
+
+    import agsdist
+
+    steps = [step for step, enabled in [('checkstyle', args.checkstyle),
+                                        ('javac', not args.nocompile),
+                                        ('java', not args.norun)]
+             if enabled]
+
+    def payload(student, step):
+        return lambda: {'student': student_name(student), 'step': step,
+                        'files': agsdist.pack(student)}
+
+    jobs = {}
+    for student in students():
+        for step in steps:
+            # Running needs the class files of compiling
+            deps = [(student, 'javac')] \
+                if step == 'java' and 'javac' in steps else []
+            jobs[(student, step)] = (deps, payload(student, step))
+
+    def report_job(key, result, worker):
+        student, step = key
+        if result.get('error'):
+            msg.review(f'{msg.name(student)} {step} could not be run: '
+                       f'{result["error"]}')
+            return
+        # A worker only reports on the student of its job
+        rows = [row for row in result['rows']
+                if row and row[0] == student_name(student)]
+        if len(rows) != len(result['rows']):
+            msg.warn(f'Ignoring {len(result["rows"]) - len(rows)} row(s) of '
+                     f'other students from {worker}')
+        result['rows'] = rows
+        agsdb.insert(rows)
+        if result.get('files'):
+            agsdist.unpack(result['files'], student)
+        failed = sum(1 for row in result['rows'] if row[3] != 0)
+        msg.echo(f'{msg.align_left(msg.name(student), 30)}'
+                 f'{msg.align_left(step, 12)}'
+                 f'{len(result["rows"]) - failed}/{len(result["rows"])} passed'
+                 f' ({worker})')
+        if failed:
+            msg.review(f'{msg.name(student)} {step} failed on {worker}')
+
+    hello = {'config': util.__assignment_config__,
+             'args': {k: getattr(args, k) for k in DIST_ARGS},
+             'files': agsdist.pack('.', dist_shared())}
+    token = os.environ.get(agsdist.TOKEN)
+    if not token:
+        token = secrets.token_urlsafe(16)
+        msg.info(f'Start workers with {agsdist.TOKEN}={token}')
+    agsdist.serve(agsdist.address(address), jobs, hello, report_job, token)
+    agsdb.flush()
+
+
+def dist_shared():
+    """ Return the files outside submission/ that students read: the files
+    of the assignment directory, which `custom run` commands reach through
+    ../../, and the `input` and `output` files of `expected`. The zips, the
+    database and the files of the grader (.ags-*) stay on the coordinator.
+    """
+
+    paths = set()
+    for parent, dirs, files in os.walk('.'):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and
+                   not (parent == '.' and d in ('submission', 'ts-bin'))]
+        paths.update(os.path.normpath(os.path.join(parent, f))
+                     for f in files
+                     if not f.startswith('.') and not f.endswith('.zip')
+                     and not f.startswith('ags.db'))
+    for spec in (util.get_conf_asmt('expected') or {}).values():
+        for key in ('input', 'output'):
+            if not spec.get(key):
+                continue
+            # Relative to a student directory
+            path = os.path.normpath(os.path.join('submission', '_',
+                                                 spec[key]))
+            if not path.startswith(('submission', '..')) and \
+                    os.path.isfile(path):
+                paths.add(path)
+    return sorted(paths)
+
+
+def dist_work(address):
+    """ Run jobs of a coordinator until it has none left. Each job runs in
+    content/.dist/[host]-[pid]/submission/[student], so the relative lib
+    path resolves as in a real assignment directory.
+    """
+
+    import socket
+
+    import agsdist
+
+    token = os.environ.get(agsdist.TOKEN)
+    if not token:
+        msg.fatal(f'Set {agsdist.TOKEN} to the token of the coordinator')
+    root = os.path.join('content', '.dist',
+                        f'{socket.gethostname()}-{os.getpid()}')
+    os.makedirs(os.path.join(root, 'submission'))
+    os.chdir(root)
+    agsdb.open_db(':memory:')
+
+    def run(hello, job):
+        if not os.path.exists('.ready'):
+            for k, v in hello['args'].items():
+                setattr(args, k, v)
+            util.__assignment_config__ = hello['config']
+            agsdist.unpack(hello['files'], '.')
+            open('.ready', 'w').close()
+        return dist_job(job)
+
+    try:
+        agsdist.work(agsdist.address(address), run, token)
+    except PermissionError as e:
+        msg.fatal(str(e))
+    finally:
+        agsdb.close()
+        os.chdir(os.path.join('..', '..', '..'))
+        shutil.rmtree(root, ignore_errors=True)
+    msg.info('No jobs left')
+
+
+def dist_job(job):
+    """ Run one `(student, step)` job and return its result message. """
+
+    import agsdist
+
+    student = os.path.join('submission', job['student'])
+    shutil.rmtree(student, ignore_errors=True)
+    agsdist.unpack(job['files'], student)
+    msg.echo(f'{msg.name(student)} {job["step"]}')
+
+    # Nothing of a job that fails is left for the next one
+    try:
+        if job['step'] == 'checkstyle':
+            checkstyle_counts([student], util.get_conf_asmt('src') or [],
+                              util.get_conf_asmt('test') or [])
+        elif job['step'] == 'javac':
+            for result in compile_student(student):
+                report_javac(result, student)
+        elif job['step'] == 'java':
+            os.chdir(student)
+            try:
+                java_student()
+            finally:
+                os.chdir(os.path.join('..', '..'))
+
+        result = {'rows': agsdb.rows(job['student'])}
+        if job['step'] == 'javac':
+            result['files'] = agsdist.pack(
+                student,
+                [os.path.basename(f)
+                 for f in glob.glob(os.path.join(student, '*.class'))])
+    finally:
+        agsdb.forget([job['student']])
+        shutil.rmtree(student, ignore_errors=True)
+    return result
+
+
+def report():
+    """ Print the results recorded for the current assignment. """
+
+    rows = agsdb.summary()
+    if not rows:
+        msg.info('No results recorded')
+        return
+
+    current = None
+    for student, step, total, failed, count, duration in rows:
+        if student != current:
+            current = student
+            msg.echo(msg.name(student))
+        if step == 'checkstyle':
+            result = f'{count or 0} violation(s)'
+        else:
+            result = f'{total - failed}/{total} passed'
+        line = f'{msg.align_left(step, 12)}{msg.align_left(result, 24)}'
+        msg.echo(f'  {line}{duration or 0:8.2f}s')
+    report_tests(args.slowest or 10)
+
+
+def report_tests(n=10):
+    """ Print the pass rate of every JUnit test over all students, and
+    the `n` slowest tests.
+    """
+
+    rows = agsdb.test_summary()
+    if not rows:
+        return
+
+    # Only failed tests are known if JUnitCore output was parsed, so the
+    # students that ran a test are the ones that ran its class
+    ran = {cls: students for cls, test, students, *_ in rows if not test}
+    msg.info('Tests')
+    for cls, test, students, failed, unfinished, *_ in rows:
+        total = ran.get(cls, students)
+        passed = total - failed - unfinished
+        line = f'{msg.align_left(cls, 24)}{msg.align_left(test or "*", 28)}'
+        line += f'{passed:4}/{total:<4} {100 * passed / total:5.1f}%'
+        if unfinished:
+            line += f'  {unfinished} unfinished'
+        msg.echo(f'  {line}')
+
+    timed = sorted((r for r in rows if r[1] and r[6] is not None),
+                   key=lambda r: r[6], reverse=True)[:n]
+    if timed:
+        msg.info(f'Slowest {len(timed)} tests')
+        for cls, test, _, _, _, mean, longest in timed:
+            name = msg.align_left(f'{cls}.{test}', 52)
+            msg.echo(f'  {name}mean {mean:7.3f}s  max {longest:7.3f}s')
+
+
+def export(path):
+    """ Write the recorded results as a gradebook to `path`. """
+
+    import agsexport
+
+    try:
+        points = dict(util.get_conf_glob('grade') or {},
+                      **(util.get_conf_asmt('grade') or {}))
+        n = agsexport.export(path, load_participants(), points)
+    except (OSError, ValueError) as e:
+        msg.fatal(f'Cannot export the gradebook: {e}')
+    msg.info(f'Exported {n} student(s) to {msg.underline(path)}')
+
+
+def trace_summary():
+    """ Print the slowest commands and write the trace file. """
+
+    agstrace.print_summary(args.slowest or 10)
+    if args.trace:
+        path = os.path.join(cwd_start, args.trace)
+        agstrace.write_chrome(path)
+        msg.info(f'Trace written to {msg.underline(path)}')
+
+
+def build_parser():
+    """ Return the parser of the command line arguments. """
 
     parser = argparse.ArgumentParser(
         description='The automatic grading script for CSC 116. '
@@ -415,11 +1763,147 @@ if __name__ == '__main__':
     parser.add_argument('-ns', '--nostacktrace',
                         help='do not print stacktrace',
                         action='store_true')
+    parser.add_argument('--tslink',
+                        help='how TS files are put into student directories; '
+                        'with hardlink/symlink a program overwriting a TS '
+                        'file changes it for every student',
+                        choices=['copy', 'hardlink', 'symlink'],
+                        default='copy')
+    parser.add_argument('--tsprecompile',
+                        help='compile TS files once per distinct student API',
+                        action='store_true')
+    parser.add_argument('-bc', '--batchcompile',
+                        help='compile all files of a student with one javac',
+                        action='store_true')
+    parser.add_argument('--daemon',
+                        help='compile in a persistent JVM helper',
+                        action='store_true')
+    parser.add_argument('--no-cache',
+                        help='do not use the compile cache',
+                        dest='nocache',
+                        action='store_true')
+    parser.add_argument('--resume',
+                        help='skip steps that already have results',
+                        action='store_true')
+    parser.add_argument('--report',
+                        help='print the recorded results and exit',
+                        action='store_true')
+    parser.add_argument('--export',
+                        help='write the recorded results as a gradebook to '
+                        'FILE (.csv or .json) and exit; can be repeated',
+                        metavar='FILE',
+                        action='append')
+    parser.add_argument('--batch',
+                        help='run without prompts; failures are listed for '
+                        'review at the end',
+                        action='store_true')
+    parser.add_argument('--retries',
+                        help='number of automatic retries in batch mode',
+                        type=int,
+                        default=0)
+    parser.add_argument('--timeout',
+                        help='wall-clock seconds a student program may run '
+                        '(overrides the configured limits)',
+                        type=float)
+    parser.add_argument('--parallel',
+                        help='run the TS test order of all students as '
+                        'concurrent tasks (implies --batch)',
+                        action='store_true')
+    parser.add_argument('--incremental',
+                        help='only grade students whose submission changed '
+                        'since the last run',
+                        action='store_true')
+    parser.add_argument('--student',
+                        help='only grade students matching PATTERN '
+                        '(e.g. "Doe*"); can be repeated',
+                        metavar='PATTERN',
+                        action='append')
+    parser.add_argument('--students-file',
+                        help='only grade the students listed in FILE, one '
+                        'name or pattern per line',
+                        dest='studentsfile',
+                        metavar='FILE')
+    parser.add_argument('--from',
+                        help='start at student NAME, in alphabetical order',
+                        dest='start',
+                        metavar='NAME')
+    parser.add_argument('--serve',
+                        help='hand out the grading steps to workers '
+                        'connecting to [HOST]:PORT (PORT alone listens on '
+                        'this machine only; workers need the token in '
+                        'AGS_DIST_TOKEN)',
+                        metavar='ADDRESS')
+    parser.add_argument('--worker',
+                        help='run grading steps for the coordinator at '
+                        'HOST:PORT with the token in AGS_DIST_TOKEN (no '
+                        'assignment needed)',
+                        metavar='ADDRESS')
+    parser.add_argument('--trace',
+                        help='write the time of every stage and command as '
+                        'Chrome trace events to FILE',
+                        metavar='FILE')
+    parser.add_argument('--slowest',
+                        help='print the N slowest commands at the end '
+                        '(10 with --trace)',
+                        metavar='N',
+                        type=int)
+    parser.add_argument('--plain',
+                        help='print without colors, e.g. into a file '
+                        '(also if NO_COLOR is set)',
+                        action='store_true')
+    parser.add_argument('--jobs',
+                        help='number of students compiled concurrently',
+                        type=int,
+                        default=1)
+    parser.add_argument('--similarity',
+                        help='print the N most similar pairs of submissions '
+                        '(default: 20)',
+                        metavar='N',
+                        nargs='?',
+                        type=int,
+                        const=20)
+    parser.add_argument('--similarity-index',
+                        help='also compare with the saved similarity index '
+                        'FILE, e.g. of an earlier semester; can be repeated',
+                        metavar='FILE',
+                        dest='simindex',
+                        action='append')
+    parser.add_argument('--save-similarity-index',
+                        help='save the similarity index of this assignment '
+                        'to FILE',
+                        metavar='FILE',
+                        dest='simsave')
+    parser.add_argument('--prefetch',
+                        help='homework submissions prepared ahead of the '
+                        'one under review (default: 3)',
+                        type=int,
+                        default=3)
+    return parser
+
+
+if __name__ == '__main__':
+    if sys.hexversion < 0x03060000:
+        msg.echo('Python version >= 3.6 is required')
+        exit(1)
+    # Relative paths in arguments are relative to where ags was started
+    cwd_start = os.getcwd()
+    os.chdir(os.path.dirname(__file__))
+
+    args = build_parser().parse_args()
+    if args.plain or os.environ.get('NO_COLOR'):
+        msg.set_console(msg.Plain())
+    if args.jobs < 1:
+        msg.fatal('--jobs must be at least 1')
+    if args.batch or args.parallel or args.worker:
+        msg.batch(args.retries)
+        atexit.register(msg.print_review)
 
-    args = parser.parse_args()
+    if args.trace or args.slowest:
+        agstrace.enable()
+        atexit.register(trace_summary)
 
     if args.version:
-        print(open('./VERSION').read())
+        msg.echo(open('./VERSION').read())
         exit(0)
 
     msg.info('Starting service...')
@@ -428,6 +1912,13 @@ if __name__ == '__main__':
         util.init(force)
         exit()
 
+    if args.worker:
+        util.read_config_glob()
+        path_lib = util.get_conf_glob('lib')
+        default_open = util.get_conf_glob('open')
+        dist_work(args.worker)
+        exit(0)
+
     asmt_name, asmt_cat, asmt_num = None, None, None
     if args.exercise:
         asmt_cat = 'exercise'
@@ -459,18 +1950,45 @@ if __name__ == '__main__':
     path_lib = util.get_conf_glob('lib')
     default_open = util.get_conf_glob('open')
 
+    if not (args.report or args.export):
+        agsjunit.build(path_lib)
+    if args.daemon and not agsdaemon.start(path_lib, args.jobs):
+        args.daemon = False
+    atexit.register(agsdaemon.stop)
+
     os.chdir(path_asmt)
+    agsdb.open_db('ags.db')
+    atexit.register(agsdb.close)
+    if args.report or args.export:
+        if args.report:
+            report()
+        for path in args.export or []:
+            export(os.path.join(cwd_start, path))
+        exit(0)
+
     if precheck() != 0:
         msg.fatal('zip file or /submission not found')
     rename()
-    if args.homework:
+    if args.incremental:
+        agsdb.forget([student_name(s) for s in students()])
+    graded = True
+    if args.serve:
+        if args.homework or args.tstest:
+            msg.fatal('--serve only supports checkstyle, compile and run')
+        dist_serve(args.serve)
+    elif args.homework:
         hw()
     elif args.tstest:
         ts_test()
     else:
+        if args.similarity or args.simsave:
+            similarity()
         if args.checkstyle:
             checkstyle_all()
         if not args.nocompile:
             javac_all()
         if not args.norun:
             java_all()
+        graded = args.checkstyle or not (args.nocompile and args.norun)
+    if graded:
+        save_manifest([student_name(s) for s in students()])
@@ -0,0 +1,144 @@
+""" Client of the persistent JVM helper in lib/AgsDaemon.java.
+
+The helper compiles through `javax.tools`, so a grading run does not pay
+JVM startup for every file. Programs and JUnit tests are not run in it: they
+need their own directory, stdin and limits, which a shared JVM cannot give.
+All requests return `None` if the helper is not available or dies, in
+which case the caller falls back to running javac/java as a subprocess.
+"""
+
+import os
+import queue
+import select
+import subprocess as sp
+import threading
+
+import agsmsg as msg
+
+__home__ = None
+__size__ = 0
+__started__ = 0
+__idle__ = queue.Queue()
+__lock__ = threading.Lock()
+
+
+def start(lib, size=1):
+    """ Build the helper in `lib` if it is outdated and allow up to `size`
+    helper JVMs to run at the same time. Return `True` on success.
+    """
+
+    global __home__, __size__
+    src = os.path.join(lib, 'AgsDaemon.java')
+    out = os.path.join(lib, 'daemon')
+    cls = os.path.join(out, 'AgsDaemon.class')
+    if not os.path.exists(cls) \
+            or os.path.getmtime(cls) < os.path.getmtime(src):
+        msg.info('Building JVM helper...')
+        try:
+            proc = sp.run(['javac', '-d', out, src],
+                          stdout=sp.PIPE, stderr=sp.PIPE)
+        except OSError:
+            proc = None
+        if proc is None or proc.returncode != 0:
+            msg.warn('Failed to build JVM helper, using javac/java instead')
+            return False
+
+    __home__ = os.path.abspath(out)
+    __size__ = size
+    return True
+
+
+def stop():
+    """ Terminate all idle helper JVMs. """
+
+    global __started__
+    while True:
+        try:
+            proc = __idle__.get_nowait()
+        except queue.Empty:
+            break
+        if proc is None:
+            continue
+        proc.stdin.close()
+        proc.wait()
+        with __lock__:
+            __started__ -= 1
+
+
+def compile(cwd, classpath, files, timeout=None):
+    """ Compile `files` in `cwd`. Return `(exit code, diagnostics)`. """
+    return request('compile', cwd, classpath, files, timeout)
+
+
+def request(op, cwd, classpath, items, timeout=None):
+    """ Send a request to an idle helper and return `(exit code, output)`,
+    or `None` if no helper could answer within `timeout` seconds.
+    """
+
+    proc = acquire()
+    if proc is None:
+        return None
+
+    line = '\t'.join([op, os.path.abspath(cwd), classpath] + list(items))
+    try:
+        proc.stdin.write(f'{line}\n'.encode(encoding='utf-8'))
+        proc.stdin.flush()
+        if timeout is not None and \
+                not select.select([proc.stdout], [], [], timeout)[0]:
+            raise TimeoutError(f'No reply within {timeout}s')
+        rc, size = proc.stdout.readline().split()
+        out = proc.stdout.read(int(size)).decode(encoding='utf-8',
+                                                 errors='replace')
+    except (OSError, ValueError):
+        # Dead or hanging (e.g. a student called System.exit)
+        release(proc, broken=True)
+        return None
+
+    release(proc)
+    return int(rc), out
+
+
+def acquire():
+    """ Return an idle helper, starting a new one if the limit allows. """
+
+    global __started__
+    if __home__ is None:
+        return None
+
+    proc = None
+    while proc is None:
+        try:
+            proc = __idle__.get_nowait()
+            continue
+        except queue.Empty:
+            pass
+        with __lock__:
+            spawn = __started__ < __size__
+            if spawn:
+                __started__ += 1
+        if not spawn:
+            # `None` is queued when a helper dies and frees its slot
+            proc = __idle__.get()
+            continue
+        try:
+            proc = sp.Popen(['java', '-cp', __home__, 'AgsDaemon'],
+                            stdin=sp.PIPE, stdout=sp.PIPE)
+        except OSError:
+            with __lock__:
+                __started__ -= 1
+            return None
+    return proc
+
+
+def release(proc, broken=False):
+    """ Return a helper to the pool, or kill it if it is `broken`. """
+
+    global __started__
+    if not broken:
+        __idle__.put(proc)
+        return
+    proc.kill()
+    proc.wait()
+    with __lock__:
+        __started__ -= 1
+    __idle__.put(None)
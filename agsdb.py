@@ -0,0 +1,250 @@
+""" Results of a grading run, stored in an SQLite database per assignment.
+
+Every compile, run, checkstyle and custom command records one row per
+(student, step, target). A later result of the same step replaces the
+earlier one. Rows are buffered and written in batches, one transaction
+each.
+
+JUnit runs also record one row per test in `tests` (see `agsjunit`).
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+__conn__ = None
+__pending__ = []
+__lock__ = threading.Lock()
+
+BATCH_SIZE = 100
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    student  TEXT NOT NULL,
+    step     TEXT NOT NULL,
+    target   TEXT NOT NULL,
+    rc       INTEGER,
+    duration REAL,
+    out_sha1 TEXT,
+    err_sha1 TEXT,
+    count    INTEGER,
+    created  REAL,
+    truncated INTEGER NOT NULL DEFAULT 0,
+    total    INTEGER,
+    PRIMARY KEY (student, step, target)
+)
+'''
+
+TESTS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tests (
+    student  TEXT NOT NULL,
+    class    TEXT NOT NULL,
+    test     TEXT NOT NULL,
+    status   TEXT NOT NULL,
+    duration REAL,
+    message  TEXT,
+    created  REAL,
+    PRIMARY KEY (student, class, test)
+)
+'''
+
+# Columns added after the first version: `(name, definition)`
+MIGRATIONS = [('truncated', 'INTEGER NOT NULL DEFAULT 0'),
+              ('total', 'INTEGER')]
+
+
+def open_db(path):
+    """ Open (and create if needed) the results database at `path`. """
+
+    global __conn__
+    __conn__ = sqlite3.connect(path, check_same_thread=False)
+    __conn__.execute(SCHEMA)
+    __conn__.execute(TESTS_SCHEMA)
+    columns = {row[1] for row in
+               __conn__.execute('PRAGMA table_info(results)')}
+    for name, definition in MIGRATIONS:
+        if name not in columns:
+            __conn__.execute(f'ALTER TABLE results ADD COLUMN {name} '
+                             f'{definition}')
+    __conn__.commit()
+
+
+def digest(text):
+    """ Return the SHA-1 of `text`, or `None` if it is empty. """
+    return hashlib.sha1(text.encode()).hexdigest() if text else None
+
+
+def record(student, step, target, rc, duration=None, out='', err='',
+           count=None, truncated=False, total=None):
+    """ Record the result of a step. Written with the next `flush()`.
+    `count` is out of `total` if that is given, e.g. passed tests.
+    `truncated` flags output that was cut to the configured limit.
+    """
+
+    if __conn__ is None:
+        return
+    row = (student, step, target, rc, duration, digest(out), digest(err),
+           count, time.time(), int(bool(truncated)), total)
+    with __lock__:
+        __pending__.append(row)
+        full = len(__pending__) >= BATCH_SIZE
+    if full:
+        flush()
+
+
+def flush():
+    """ Write all pending rows in one transaction. """
+
+    if __conn__ is None:
+        return
+    with __lock__:
+        rows = __pending__[:]
+        del __pending__[:]
+        if rows:
+            with __conn__:
+                __conn__.executemany('INSERT OR REPLACE INTO results '
+                                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '
+                                     '?)', rows)
+
+
+def insert(rows):
+    """ Add rows of another database (see `rows()`) as they are. Raise
+    `ValueError` if a row does not have the 11 columns of `results`.
+    """
+
+    if __conn__ is None:
+        return
+    rows = [tuple(row) for row in rows]
+    if any(len(row) != 11 for row in rows):
+        raise ValueError('Rows do not match the results table')
+    with __lock__:
+        __pending__.extend(rows)
+    flush()
+
+
+def rows(student):
+    """ Return all rows of `student`. """
+
+    if __conn__ is None:
+        return []
+    flush()
+    with __lock__:
+        return __conn__.execute('SELECT student, step, target, rc, '
+                                'duration, out_sha1, err_sha1, count, '
+                                'created, truncated, total FROM results '
+                                'WHERE student = ?',
+                                (student,)).fetchall()
+
+
+def forget(students):
+    """ Remove all results of `students`. """
+
+    if __conn__ is None:
+        return
+    flush()
+    with __lock__, __conn__:
+        for table in ('results', 'tests'):
+            __conn__.executemany(f'DELETE FROM {table} WHERE student = ?',
+                                 [(s,) for s in students])
+
+
+def record_tests(student, cls, tests):
+    """ Replace the tests of the test class `cls` of `student` with
+    `tests`, dicts as returned by `agsjunit.results()`.
+    """
+
+    if __conn__ is None:
+        return
+    now = time.time()
+    rows = [(student, t['class'], t['test'], t['status'], t['duration'],
+             t['message'], now) for t in tests]
+    with __lock__, __conn__:
+        __conn__.execute('DELETE FROM tests WHERE student = ? AND class = ?',
+                         (student, cls))
+        __conn__.executemany('INSERT OR REPLACE INTO tests '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+def students():
+    """ Return the names of the students with recorded results. """
+
+    if __conn__ is None:
+        return set()
+    flush()
+    with __lock__:
+        return {row[0] for row in
+                __conn__.execute('SELECT DISTINCT student FROM results')}
+
+
+def lookup(student, step, target):
+    """ Return the recorded `(rc, count)` of a step, or `None`. """
+
+    if __conn__ is None:
+        return None
+    flush()
+    with __lock__:
+        return __conn__.execute('SELECT rc, count FROM results '
+                                'WHERE student = ? AND step = ? '
+                                'AND target = ?',
+                                (student, step, target)).fetchone()
+
+
+def results():
+    """ Yield all rows in the order of the primary key, one at a time:
+    `(student, step, target, rc, duration, count, total, truncated)`.
+    """
+
+    if __conn__ is None:
+        return
+    flush()
+    yield from __conn__.execute(
+        'SELECT student, step, target, rc, duration, count, total, '
+        'truncated FROM results ORDER BY student, step, target')
+
+
+def summary():
+    """ Return one row per student and step:
+    `(student, step, total, failed, count, duration)`.
+    """
+
+    if __conn__ is None:
+        return []
+    flush()
+    with __lock__:
+        return __conn__.execute(
+            'SELECT student, step, COUNT(*), '
+            'SUM(CASE WHEN rc != 0 THEN 1 ELSE 0 END), '
+            'SUM(count), SUM(duration) '
+            'FROM results GROUP BY student, step '
+            'ORDER BY student, step').fetchall()
+
+
+def test_summary():
+    """ Return one row per test, and per test class (test `''`), of all
+    students: `(class, test, students, failed, unfinished, mean duration,
+    max duration)`.
+    """
+
+    if __conn__ is None:
+        return []
+    flush()
+    with __lock__:
+        return __conn__.execute(
+            'SELECT class, test, COUNT(*), '
+            "SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END), "
+            "SUM(CASE WHEN status = 'unfinished' THEN 1 ELSE 0 END), "
+            'AVG(duration), MAX(duration) '
+            'FROM tests GROUP BY class, test '
+            'ORDER BY class, test').fetchall()
+
+
+def close():
+    """ Flush pending rows and close the database. """
+
+    global __conn__
+    if __conn__ is None:
+        return
+    flush()
+    __conn__.close()
+    __conn__ = None
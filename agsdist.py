@@ -0,0 +1,272 @@
+""" Grade on several machines: a coordinator hands out `(student, step)`
+jobs over TCP, workers run them and send the results back.
+
+Every message is a JSON object, prefixed with its length as a 4-byte
+big-endian integer. Files travel as base64-encoded zips.
+
+```text
+worker                            coordinator
+{"op": "hello", "token": ...} ->  {"op": "hello", ...}
+                                  {"op": "denied"} (wrong token)
+{"op": "get"}                 ->  {"op": "job", "id": 1, ...}
+                                  {"op": "wait"} (nothing ready yet)
+                                  {"op": "done"} (all jobs finished)
+{"op": "result", "id": 1, ...}
+{"op": "failed", "id": 1, "error": "..."} (the job raised an error)
+```
+
+A job is only handed out when the jobs it depends on have finished, and
+the jobs of a worker that disconnects or fails are handed out again, up to
+`ATTEMPTS` times in all.
+
+Workers run whatever the coordinator sends and the coordinator stores what
+workers send back, so both sides share a secret token, taken from the
+environment variable `AGS_DIST_TOKEN`. A worker is only served once its
+hello has the token, and results are only taken for the jobs it runs.
+"""
+
+import base64
+import hmac
+import io
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import zipfile
+
+import agsmsg as msg
+
+HEADER = struct.Struct('>I')
+
+# Environment variable of the shared token
+TOKEN = 'AGS_DIST_TOKEN'
+
+# Times a job is handed out before it is given up
+ATTEMPTS = 3
+
+
+def address(text):
+    """ Return `(host, port)` of `HOST:PORT`, `:PORT` (all interfaces) or
+    `PORT` (this machine only).
+    """
+
+    host, colon, port = text.rpartition(':')
+    return host if colon else '127.0.0.1', int(port)
+
+
+def send(sock, message):
+    """ Send a message. """
+
+    data = json.dumps(message).encode(encoding='utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def receive(sock):
+    """ Return the next message, or `None` if the connection is closed. """
+
+    header = receive_bytes(sock, HEADER.size)
+    if header is None:
+        return None
+    data = receive_bytes(sock, HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return json.loads(data.decode(encoding='utf-8'))
+
+
+def receive_bytes(sock, size):
+    """ Return exactly `size` bytes, or `None` if the connection closes. """
+
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 16))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def pack(root, paths=None):
+    """ Return the files `paths` (all files if `None`) in `root` as a
+    base64-encoded zip.
+    """
+
+    if paths is None:
+        paths = []
+        for parent, _, files in os.walk(root):
+            paths.extend(os.path.relpath(os.path.join(parent, f), root)
+                         for f in files)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for path in sorted(paths):
+            zf.write(os.path.join(root, path), path)
+    return base64.b64encode(buffer.getvalue()).decode(encoding='ascii')
+
+
+def unpack(data, root):
+    """ Extract the files of `pack()` into `root`. """
+
+    buffer = io.BytesIO(base64.b64decode(data))
+    with zipfile.ZipFile(buffer) as zf:
+        for name in zf.namelist():
+            if '..' in name.split('/') or os.path.isabs(name):
+                raise ValueError(f'Unsafe path in job: {name}')
+        zf.extractall(root)
+
+
+def serve(address_, jobs, hello, report, token):
+    """ Hand out `jobs` to the workers connecting to `address_` with the
+    shared `token` until all of them are done.\n
+    `jobs` is a dict `{key: (dependencies, payload)}`, where `payload()`
+    returns the job message. It is called when the job is handed out, so it
+    sees the results of the dependencies. `hello` is the message every
+    worker gets first. `report(key, result, worker)` is called with the
+    result message of every job, one at a time. A job given up after
+    `ATTEMPTS` is reported with `{'rows': [], 'error': ...}`.
+    """
+
+    keys = list(jobs)
+    state = {'pending': list(keys), 'running': {}, 'done': set(),
+             'attempts': dict.fromkeys(keys, 0)}
+    lock = threading.Lock()
+
+    def next_job(worker):
+        with lock:
+            for key in state['pending']:
+                if all(d in state['done'] for d in jobs[key][0]):
+                    state['pending'].remove(key)
+                    state['running'][key] = worker
+                    state['attempts'][key] += 1
+                    return key
+            return None
+
+    def retry(key, worker, error):
+        # Called with the lock held
+        if state['attempts'][key] < ATTEMPTS:
+            state['pending'].insert(0, key)
+            return True
+        msg.fail(f'Giving up job {keys.index(key)} after {ATTEMPTS} '
+                 f'attempts: {error}')
+        report(key, {'rows': [], 'error': error}, worker)
+        state['done'].add(key)
+        return False
+
+    def handle(conn, worker):
+        try:
+            request = receive(conn)
+            if not isinstance(request, dict) or \
+                    request.get('op') != 'hello' or \
+                    not hmac.compare_digest(str(request.get('token')), token):
+                msg.warn(f'Worker {worker} denied: wrong token')
+                send(conn, {'op': 'denied'})
+                return
+            send(conn, dict(hello, op='hello'))
+            while True:
+                request = receive(conn)
+                if request is None:
+                    break
+                if request['op'] == 'get':
+                    key = next_job(worker)
+                    if key is not None:
+                        send(conn, dict(jobs[key][1](), op='job',
+                                        id=keys.index(key)))
+                    elif len(state['done']) == len(keys):
+                        send(conn, {'op': 'done'})
+                    else:
+                        send(conn, {'op': 'wait'})
+                elif request['op'] in ('result', 'failed'):
+                    key = keys[request['id']]
+                    with lock:
+                        if state['running'].get(key) != worker:
+                            raise ValueError(f'result of job {request["id"]}'
+                                             ' it does not run')
+                        del state['running'][key]
+                        if request['op'] == 'failed':
+                            msg.warn(f'Job {request["id"]} failed on '
+                                     f'{worker}: {request.get("error")}')
+                            retry(key, worker, str(request.get('error')))
+                        else:
+                            report(key, request, worker)
+                            state['done'].add(key)
+        except (OSError, ValueError, LookupError, TypeError) as e:
+            msg.warn(f'Lost worker {worker}: {e}')
+        finally:
+            conn.close()
+            with lock:
+                lost = [k for k, w in state['running'].items() if w == worker]
+                for key in lost:
+                    del state['running'][key]
+                again = sum(retry(key, worker, f'lost worker {worker}')
+                            for key in lost)
+                if again:
+                    msg.warn(f'Handing out {again} job(s) of {worker} again')
+
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(address_)
+    server.listen()
+    server.settimeout(0.5)
+    host, port = server.getsockname()[:2]
+    msg.info(f'Waiting for workers on {host or "*"}:{port} '
+             f'({len(keys)} job(s))...')
+    try:
+        while True:
+            with lock:
+                if len(state['done']) == len(keys):
+                    break
+            try:
+                conn, peer = server.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            worker = f'{peer[0]}:{peer[1]}'
+            msg.info(f'Worker {worker} connected')
+            threading.Thread(target=handle, args=(conn, worker),
+                             daemon=True).start()
+    finally:
+        server.close()
+
+
+def work(address_, run, token, retry=30):
+    """ Connect to the coordinator at `address_` (retrying for up to `retry`
+    seconds) with the shared `token` and run jobs with `run(hello, job)`,
+    which returns the result message, until all jobs are done. A job
+    raising an error is reported as failed. Raise `PermissionError` if the
+    coordinator denies the token.
+    """
+
+    deadline = time.time() + retry
+    while True:
+        try:
+            sock = socket.create_connection(address_)
+            break
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(1)
+
+    with sock:
+        send(sock, {'op': 'hello', 'token': token})
+        hello = receive(sock)
+        if hello is not None and hello['op'] == 'denied':
+            raise PermissionError(f'Coordinator denied the token of {TOKEN}')
+        while hello is not None:
+            send(sock, {'op': 'get'})
+            job = receive(sock)
+            if job is None or job['op'] == 'done':
+                break
+            if job['op'] == 'wait':
+                time.sleep(1)
+                continue
+            try:
+                result = run(hello, job)
+            except Exception as e:
+                # Any error of a job, e.g. in a student file, must not take
+                # the worker with it
+                error = f'{type(e).__name__}: {e}'
+                msg.fail(f'Job {job["id"]} failed: {error}')
+                send(sock, {'op': 'failed', 'id': job['id'], 'error': error})
+                continue
+            send(sock, dict(result, op='result', id=job['id']))
@@ -0,0 +1,179 @@
+""" Export the recorded results of an assignment as a gradebook.
+
+One row per student, aggregated from the results database in a single pass
+over the rows (they come sorted by student), so a class of any size never
+has to fit in memory:
+
+- compiled files out of all files, and the files that failed to compile
+- tests passed and run, parsed from the output of JUnitCore
+- checkstyle violations
+- the mean similarity of the program output to the expected output
+- the time spent running the programs and tests
+- whether any output was truncated
+
+A `.csv` file can be uploaded as a Moodle grading worksheet: an import
+finds the student by the `Identifier` column (`Participant 12345`, from the
+folder names in the Moodle zip) and takes the `Grade` and `Feedback
+comments` columns. The feedback sums up the results. The grade is computed
+from the `grade` setting, points for each part of a full score, and left
+empty without it:
+
+```yaml
+grade:
+  compiled: 20    # times the share of compiled files
+  tests: 50       # times the share of passed tests
+  output: 20      # times the mean output similarity
+  checkstyle: 10  # one point off per violation
+```
+
+A `.json` file has the same fields, with the failed files as a list.
+"""
+
+import csv
+import json
+import os
+
+import agsdb
+
+COLUMNS = ['Identifier', 'Full name', 'Grade', 'Feedback comments',
+           'Compiled', 'Compile failures', 'Tests passed', 'Tests run',
+           'Checkstyle violations', 'Output similarity', 'Run time (s)',
+           'Truncated']
+
+# Steps not counted as run time
+NOT_RUN = ('javac', 'checkstyle')
+
+
+def students(rows, participants):
+    """ Yield one aggregated dict per student of the sorted `rows` of
+    `agsdb.results()`, with the Moodle participant id of `participants`.
+    """
+
+    current = None
+    for student, step, target, rc, duration, count, total, truncated in rows:
+        if student != current:
+            if current is not None:
+                yield finish(entry, similarity)
+            current = student
+            entry = {'student': student,
+                     'participant': participants.get(student),
+                     'files': 0, 'compiled': 0, 'failures': [],
+                     'passed': None, 'tests': None, 'violations': None,
+                     'time': 0.0, 'truncated': False}
+            similarity = []
+        if step == 'javac':
+            entry['files'] += 1
+            if rc == 0:
+                entry['compiled'] += 1
+            else:
+                entry['failures'].append(target)
+        elif step == 'checkstyle' and count is not None:
+            entry['violations'] = (entry['violations'] or 0) + count
+        elif step == 'output' and count is not None:
+            similarity.append(count)
+        if total is not None:
+            entry['passed'] = (entry['passed'] or 0) + (count or 0)
+            entry['tests'] = (entry['tests'] or 0) + total
+        if step not in NOT_RUN:
+            entry['time'] += duration or 0
+        entry['truncated'] = entry['truncated'] or bool(truncated)
+    if current is not None:
+        yield finish(entry, similarity)
+
+
+def finish(entry, similarity):
+    """ Complete `entry` with the mean output similarity in percent. """
+
+    entry['similarity'] = round(sum(similarity) / len(similarity)) \
+        if similarity else None
+    entry['time'] = round(entry['time'], 2)
+    return entry
+
+
+def grade(entry, points):
+    """ Return the grade of `entry` by the `points` of the `grade` setting,
+    or `None` if there are none.
+    """
+
+    if not points:
+        return None
+    total = 0.0
+    if entry['files']:
+        total += points.get('compiled', 0) * entry['compiled'] / entry['files']
+    if entry['tests']:
+        total += points.get('tests', 0) * entry['passed'] / entry['tests']
+    if entry['similarity'] is not None:
+        total += points.get('output', 0) * entry['similarity'] / 100
+    if entry['violations'] is not None:
+        total += max(points.get('checkstyle', 0) - entry['violations'], 0)
+    return round(total, 2)
+
+
+def feedback(entry):
+    """ Return the results of `entry` as a line of feedback. """
+
+    parts = [f'Compiled {entry["compiled"]}/{entry["files"]} file(s)']
+    if entry['failures']:
+        parts.append(f'compile errors in {", ".join(entry["failures"])}')
+    if entry['tests'] is not None:
+        parts.append(f'{entry["passed"]}/{entry["tests"]} test(s) passed')
+    if entry['violations'] is not None:
+        parts.append(f'{entry["violations"]} checkstyle violation(s)')
+    if entry['similarity'] is not None:
+        parts.append(f'output {entry["similarity"]}% as expected')
+    if entry['truncated']:
+        parts.append('output cut')
+    return '; '.join(parts)
+
+
+def csv_row(entry):
+    """ Return the gradebook row of `entry`, in the order of `COLUMNS`. """
+
+    participant = entry['participant']
+    return [f'Participant {participant}' if participant else '',
+            entry['student'],
+            '' if entry['grade'] is None else entry['grade'],
+            entry['feedback'], f'{entry["compiled"]}/{entry["files"]}',
+            ' '.join(entry['failures']),
+            '' if entry['passed'] is None else entry['passed'],
+            '' if entry['tests'] is None else entry['tests'],
+            '' if entry['violations'] is None else entry['violations'],
+            '' if entry['similarity'] is None else entry['similarity'],
+            entry['time'], 'yes' if entry['truncated'] else 'no']
+
+
+def export(path, participants=None, points=None):
+    """ Write the gradebook to `path`, as CSV or JSON by its extension.
+    `participants` maps students to their Moodle participant ids, and
+    `points` are those of the `grade` setting.
+    Return the number of students written.
+    """
+
+    participants = participants or {}
+
+    def entries():
+        for entry in students(agsdb.results(), participants):
+            entry['grade'] = grade(entry, points)
+            entry['feedback'] = feedback(entry)
+            yield entry
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in ('.csv', '.json'):
+        raise ValueError(f'Unknown gradebook format: {path}')
+
+    n = 0
+    with open(path, 'w', newline='') as f:
+        if ext == '.csv':
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            for entry in entries():
+                writer.writerow(csv_row(entry))
+                n += 1
+        else:
+            f.write('[')
+            for entry in entries():
+                f.write(',\n  ' if n else '\n  ')
+                json.dump(entry, f)
+                n += 1
+            f.write('\n]\n' if n else ']\n')
+    return n
@@ -0,0 +1,216 @@
+""" Per-test results of JUnit runs.
+
+JUnit tests run through lib/AgsJUnit.java when it can be built: it prints
+what JUnitCore prints and writes an event per test to a file (see the
+class comment), with its outcome and time. Otherwise the console output of
+JUnitCore is parsed, which names the failed tests only:
+
+```text
+JUnit version 4.12
+..E
+Time: 0.012
+There was 1 failure:
+1) testEmpty(StackTest)
+java.lang.AssertionError: expected:<0> but was:<1>
+...
+FAILURES!!!
+Tests run: 3,  Failures: 1
+```
+
+A test is a dict `{'class', 'test', 'status', 'duration', 'message'}`,
+where `status` is one of `passed`, `failed`, `skipped` (a failed
+assumption), `ignored` or `unfinished` (started, but the program was
+killed or exited first). The row of a whole class has the test `''`.
+"""
+
+import json
+import os
+import re
+import shlex
+import subprocess as sp
+
+import agsmsg as msg
+
+JUNITCORE = 'org.junit.runner.JUnitCore'
+RUNNER = 'AgsJUnit'
+
+OK = re.compile(r'^OK \((\d+) tests?\)', re.MULTILINE)
+FAILURES = re.compile(r'^Tests run: (\d+),\s+Failures: (\d+)', re.MULTILINE)
+TIME = re.compile(r'^Time: ([\d,.]+)', re.MULTILINE)
+# `1) testEmpty(StackTest)`, or `1) StackTest` if the class failed
+FAILURE = re.compile(r'^\d+\) (?:(\S+)\((\S+)\)|(\S+))$', re.MULTILINE)
+
+__home__ = None
+
+
+def build(lib):
+    """ Build the runner in `lib` if it is outdated. Return `True` on
+    success; JUnitCore is used otherwise.
+    """
+
+    global __home__
+    src = os.path.join(lib, f'{RUNNER}.java')
+    out = os.path.join(lib, 'junit-runner')
+    cls = os.path.join(out, f'{RUNNER}.class')
+    if not os.path.exists(cls) \
+            or os.path.getmtime(cls) < os.path.getmtime(src):
+        msg.info('Building JUnit runner...')
+        try:
+            proc = sp.run(['javac', '-cp', os.path.join(lib, '*'),
+                           '-d', out, src], stdout=sp.PIPE, stderr=sp.PIPE)
+        except OSError:
+            proc = None
+        if proc is None or proc.returncode != 0:
+            msg.warn('Failed to build JUnit runner, using JUnitCore instead')
+            return False
+
+    __home__ = os.path.abspath(out)
+    return True
+
+
+def command(cp, classes, events):
+    """ Return the command running the JUnit test `classes` (a string)
+    with the classpath `cp`, writing the events to the file `events`.
+    """
+
+    if __home__ is None:
+        return f'java -cp "{cp}" {JUNITCORE} {classes}'
+    return f'java -cp "{__home__}:{cp}" {RUNNER} ' \
+        f'{shlex.quote(events)} {classes}'
+
+
+def events_file(log):
+    """ Return the events file of a run whose output goes to `log`. """
+    return f'{os.path.splitext(log)[0]}.events'
+
+
+def split(cmd):
+    """ Return `(test classes, events file or None)` of a command running
+    JUnit, or `None` for any other command.
+    """
+
+    try:
+        tokens = shlex.split(cmd)
+    except ValueError:
+        return None
+    for i, token in enumerate(tokens):
+        if token == JUNITCORE:
+            return tokens[i + 1:], None
+        if token == RUNNER and i + 1 < len(tokens):
+            return tokens[i + 2:], tokens[i + 1]
+    return None
+
+
+def prepare(cmd, cwd='.'):
+    """ Remove the events of an earlier run of `cmd` and create the folder
+    of its events file, if it runs JUnit through the runner.
+    """
+
+    junit = split(cmd)
+    if junit is None or junit[1] is None:
+        return
+    path = os.path.join(cwd, junit[1])
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def counts(out):
+    """ Return the passed and run tests in the output of JUnitCore as
+    keyword arguments of `agsdb.record()`, or `{}` if there is no summary.
+    """
+
+    match = OK.search(out)
+    if match:
+        run = int(match.group(1))
+        return {'count': run, 'total': run}
+    match = FAILURES.search(out)
+    if match:
+        run, failures = int(match.group(1)), int(match.group(2))
+        return {'count': run - failures, 'total': run}
+    return {}
+
+
+def parse(out, cls):
+    """ Return the tests of the JUnitCore output `out` of the test class
+    `cls`: the failed tests and the row of the class.
+    """
+
+    tests = []
+    for match in FAILURE.finditer(out):
+        test, owner, whole = match.groups()
+        rest = out[match.end():].lstrip('\n').split('\n', 1)[0]
+        tests.append({'class': owner or whole, 'test': test or '',
+                      'status': 'failed', 'duration': None,
+                      'message': rest.strip() or None})
+    time = TIME.search(out)
+    duration = float(time.group(1).replace(',', '')) if time else None
+    summary = counts(out)
+    status = 'unfinished' if not summary else \
+        'passed' if summary['count'] == summary['total'] else 'failed'
+    for t in tests:
+        if t['class'] == cls and not t['test']:
+            # A failure of the class itself, e.g. in @BeforeClass
+            t['duration'] = duration
+            return tests
+    tests.append({'class': cls, 'test': '', 'status': status,
+                  'duration': duration, 'message': None})
+    return tests
+
+
+def read_events(path, cls, duration=None):
+    """ Return the tests of the events file at `path` and the row of the
+    class `cls`, which took `duration` seconds.
+    """
+
+    tests = {}
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # The last line of a killed program may be cut
+                    continue
+                key = event['class'], event['test'] or ''
+                if event['event'] == 'started':
+                    tests[key] = {'class': key[0], 'test': key[1],
+                                  'status': 'unfinished', 'duration': None,
+                                  'message': None}
+                else:
+                    tests[key] = {'class': key[0], 'test': key[1],
+                                  'status': event['status'],
+                                  'duration': event['time'],
+                                  'message': event['message']}
+    except OSError:
+        return []
+    if not tests:
+        return []
+
+    statuses = {t['status'] for t in tests.values()}
+    status = 'unfinished' if 'unfinished' in statuses else \
+        'failed' if 'failed' in statuses else 'passed'
+    whole = tests.get((cls, ''))
+    if whole:
+        # A failure of the class itself, e.g. in @BeforeClass
+        whole['status'] = 'failed'
+        whole['duration'] = duration
+    else:
+        tests[cls, ''] = {'class': cls, 'test': '', 'status': status,
+                          'duration': duration, 'message': None}
+    return list(tests.values())
+
+
+def results(out, cls, events=None, duration=None):
+    """ Return `(counts, tests)` of a run of the test class `cls`: the
+    keyword arguments of `agsdb.record()` (see `counts()`) and the tests.
+    The events file is preferred over the output if it has any events.
+    """
+
+    tests = read_events(events, cls, duration) if events else []
+    if not tests:
+        return counts(out), parse(out, cls)
+
+    run = [t for t in tests if t['test'] and t['status'] != 'ignored']
+    passed = sum(t['status'] in ('passed', 'skipped') for t in run)
+    return {'count': passed, 'total': len(run)}, tests
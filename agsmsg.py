@@ -1,3 +1,10 @@
+import atexit
+from contextlib import contextmanager
+import re
+import sys
+import threading
+
+
 class style:
     """
     All styles are in ANSI escape code.
@@ -26,25 +33,174 @@ class style:
         return f'\x1b[{color}m{msg}\x1b[0m'
 
 
+class Console:
+    """ Sink writing messages to stdout. Messages are collected and written
+    at `flush()`, or once `limit` bytes are pending. A lock keeps the
+    blocks of concurrent threads apart.
+    """
+
+    def __init__(self, stream=None, limit=1 << 16):
+        self.stream = stream
+        self.limit = limit
+        self.pending = []
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            self.pending.append(text)
+            self.size += len(text)
+            if self.size >= self.limit:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        stream = self.stream or sys.stdout
+        stream.write(''.join(self.pending))
+        stream.flush()
+        self.pending = []
+        self.size = 0
+
+
+class Plain(Console):
+    """ Console sink without ANSI escape codes, e.g. for a file. """
+
+    ANSI = re.compile(r'\x1b\[[0-9;]*m')
+
+    def write(self, text):
+        super().write(self.ANSI.sub('', text))
+
+
+class Task:
+    """ Sink collecting the messages of one task, e.g. a student graded in a
+    worker thread, to be written as one block by `close()`.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.pending = []
+
+    def write(self, text):
+        self.pending.append(text)
+
+    def text(self):
+        return ''.join(self.pending)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.sink.write(self.text())
+
+
+# Sink of all threads without a task (see `task()`)
+__console__ = Console()
+# Sink of the current thread, if it runs a task
+__local__ = threading.local()
+atexit.register(lambda: __console__.flush())
+
+
+def set_console(sink):
+    """ Replace the console sink, e.g. with `Plain()`. """
+
+    global __console__
+    __console__.flush()
+    __console__ = sink
+
+
+def echo(*values, sep=' ', end='\n', flush=False):
+    """ Write `values` like `print()` does, to the sink of the current
+    thread. Nothing reaches the terminal before the next `flush()`, or
+    right away with `flush` (e.g. for progress).
+    """
+    sink = getattr(__local__, 'sink', None) or __console__
+    sink.write(sep.join(str(v) for v in values) + end)
+    if flush:
+        sink.flush()
+
+
+def flush():
+    """ Write all pending messages to the terminal. """
+    __console__.flush()
+
+
+@contextmanager
+def task(emit=True):
+    """ Collect the messages of the current thread in a `Task` sink, which
+    is yielded. With `emit`, they are written as one block at the end.
+    """
+
+    previous = getattr(__local__, 'sink', None)
+    sink = Task(__console__)
+    __local__.sink = sink
+    try:
+        yield sink
+    finally:
+        __local__.sink = previous
+        if emit:
+            sink.close()
+
+
+# Answers used instead of prompting, `None` if interactive (see `batch()`)
+__batch__ = None
+# Messages collected in batch mode for later review
+__review__ = []
+
+
+def batch(retries=0):
+    """ Switch to batch mode: no prompt waits for input.\n
+    `press_continue()` returns immediately, `ask_retry()` allows `retries`
+    retries, and `ask_yn()` returns its `default`, or no if the prompt has
+    none.
+    """
+
+    global __batch__
+    __batch__ = {'retries': retries}
+
+
+def is_batch():
+    """ Return `True` in batch mode. """
+    return __batch__ is not None
+
+
+def review(msg):
+    """ Keep a message for `print_review()` in batch mode. """
+    if __batch__ is not None:
+        __review__.append(msg)
+
+
+def print_review():
+    """ Print all messages kept by `review()`. """
+    if not __review__:
+        return
+    warn(f'{len(__review__)} item(s) to review:')
+    for i, m in enumerate(__review__):
+        warn_index(i, m)
+
+
 def info(msg, end='\n', color=style.color.green):
     """ Print a information message (Default color green). """
-    print(f'{style.stylize(color, f"INFO")}  {msg}', end=end, flush=True)
+    echo(f'{style.stylize(color, f"INFO")}  {msg}', end=end)
 
 
 def fail(msg, end='\n', color=style.color.red):
     """ Print a failing message (Default color red). """
-    print(f'{style.stylize(color, f"FAIL")}  {msg}', end=end, flush=True)
+    echo(f'{style.stylize(color, f"FAIL")}  {msg}', end=end)
 
 
 def fatal(msg):
     """ Print a failing message (Default color red) then exit with code 1. """
     fail(msg)
+    flush()
     exit(1)
 
 
 def warn(msg, end='\n', color=style.color.yellow):
     """ Print a warning message (Default color yellow). """
-    print(f'{style.stylize(color, f"WARN")}  {msg}', end=end, flush=True)
+    echo(f'{style.stylize(color, f"WARN")}  {msg}', end=end)
 
 
 def name(name_, swap=False, end='\n'):
@@ -61,13 +217,23 @@ def name(name_, swap=False, end='\n'):
 
 def press_continue(button='return'):
     """ Press a button to continue. """
+    if __batch__ is not None:
+        return
     info(f'Press <{button}> to continue')
+    flush()
     input()
 
 
+def pause():
+    """ Wait for <return> without a message (not in batch mode). """
+    if __batch__ is None:
+        flush()
+        input()
+
+
 def warn_index(index, msg, color=style.color.yellow):
     """ Print "[`index`] message" (Yellow). """
-    print(style.stylize(color, f'[{index}] {msg}'), flush=True)
+    echo(style.stylize(color, f'[{index}] {msg}'))
 
 
 # Methods below only return string #
@@ -82,9 +248,10 @@ def underline(msg):
     return style.stylize(style.font.underline, msg)
 
 
-def ask_yn(msg, type_='info'):
+def ask_yn(msg, type_='info', default=None):
     """ Prompts the user for yes (Y/y) or no (N/n).
     Returns `True` if entering Y or y, `False` otherwise.
+    In batch mode, returns `default` (`False` if `None`) without asking.
     """
     text = f'{msg} [Y/n]: '
     if type_ == 'info':
@@ -94,24 +261,38 @@ def ask_yn(msg, type_='info'):
     elif type_ == 'fail':
         fail(text, '')
 
+    if __batch__ is not None:
+        option = bool(default)
+        echo('y' if option else 'n', '(batch)')
+        return option
+
+    flush()
     option = input().lower()
     while option != 'y' and option != 'n':
         fail(f'Invalid option: {option}. Please try again: ', '')
+        flush()
         option = input().lower()
     return option == 'y'
 
 
-def ask_retry():
-    """ Ask for retry. """
+def ask_retry(attempt=0):
+    """ Ask for retry. `attempt` is the number of retries so far. """
+    if __batch__ is not None:
+        return ask_yn('Retry?', default=attempt < __batch__['retries'])
     return ask_yn('Retry?')
 
 
 def ask_index(start, end):
     """ Prompt the user for numbers. 
     Return it if is a valid index, `None` otherwise.
+    In batch mode, returns `end` (the skip option) without asking.
     """
+    if __batch__ is not None:
+        echo(end, '(batch)')
+        return end
     option = None
     while True:
+        flush()
         try:
             option = int(input())
         except ValueError:
@@ -134,19 +315,20 @@ def index_list(list, skip=True):
     If `skip` set to `False`, `[x] Skip` option will not be displayed.
     """
     for i, l in enumerate(list):
-        print(f'[{i}] {underline(l)}')
+        echo(f'[{i}] {underline(l)}')
     if skip:
-        print(f'[{i + 1}] Skip')
+        echo(f'[{i + 1}] Skip')
 
 
-def textbar(msg, length=3):
-    """ Print a message with spaces and vertical bar before it. For example:\n
+def textbar(msg, value='', length=3):
+    """ Print a message with a value and vertical bar before it. For
+    example:\n
     ```text
       5 | This is a message
     123 | This is another message
     ```
     """
-    print(f'{" " * length} | {msg}', end='\r')
+    echo(f'{align_right(value, length)} | {msg}')
 
 
 def align_left(msg, length):
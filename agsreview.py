@@ -0,0 +1,134 @@
+""" Index and prepare homework submissions for review.
+
+`index()` describes the files of a student: size, type (by content, not
+only by extension), pages of PDFs, and flags for the cases a grader has to
+look at, such as no submission or several files. `prepare()` gets a
+submission ready to be opened: it reads PDFs once, so they come from the
+page cache when the viewer starts, and converts documents to PDF with
+LibreOffice if it is installed.
+"""
+
+import glob
+import os
+import re
+import shutil
+import subprocess as sp
+
+# First bytes of the file types students submit
+MAGIC = [(b'%PDF', 'pdf'), (b'PK\x03\x04', 'zip'),
+         (b'\xd0\xcf\x11\xe0', 'doc'), (b'{\\rtf', 'rtf'),
+         (b'\x89PNG', 'png'), (b'\xff\xd8\xff', 'jpeg')]
+
+# Zip based formats, told apart by extension
+ZIPPED = ('docx', 'odt', 'pages', 'pptx', 'xlsx')
+
+# Types LibreOffice converts to PDF
+CONVERT = ('doc', 'docx', 'odt', 'rtf', 'txt')
+
+PAGE = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+COUNT = re.compile(rb'/Type\s*/Pages\b[^>]*?/Count\s+(\d+)'
+                   rb'|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b')
+
+
+def file_type(path):
+    """ Return the type of the file at `path`, e.g. `pdf` or `docx`. """
+
+    ext = os.path.splitext(path)[1][1:].lower()
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(8)
+    except OSError:
+        return 'unreadable'
+    for magic, name in MAGIC:
+        if head.startswith(magic):
+            return ext if name == 'zip' and ext in ZIPPED else name
+    return ext or 'unknown'
+
+
+def pdf_pages(path):
+    """ Return the number of pages of the PDF at `path`, or `None` if it
+    cannot be told without decompressing the file.
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    # The page tree root has the largest count
+    counts = [int(a or b) for a, b in COUNT.findall(data)]
+    if counts:
+        return max(counts)
+    pages = len(PAGE.findall(data))
+    return pages or None
+
+
+def index(folder):
+    """ Return the submission in `folder`:
+    `{'files': [{'name', 'path', 'size', 'type', 'pages'}], 'flags'}`.
+    """
+
+    files = []
+    for path in sorted(glob.glob(os.path.join(folder, '*.*'))):
+        type_ = file_type(path)
+        files.append({'name': os.path.basename(path), 'path': path,
+                      'size': os.path.getsize(path), 'type': type_,
+                      'pages': pdf_pages(path) if type_ == 'pdf' else None})
+
+    flags = []
+    if not files:
+        flags.append('no submission')
+    if len(files) > 1:
+        flags.append(f'{len(files)} files')
+    if any(f['size'] == 0 for f in files):
+        flags.append('empty file')
+    if files and not any(f['type'] == 'pdf' for f in files):
+        flags.append('no PDF')
+    if any(f['type'] == 'pdf' and f['pages'] is None and f['size']
+           for f in files):
+        flags.append('unreadable PDF')
+    return {'files': files, 'flags': flags}
+
+
+def prepare(submission, cache):
+    """ Return `{name: path to open}` of the files of `submission` (see
+    `index()`). Documents are converted to PDF in the folder `cache`.
+    """
+
+    soffice = shutil.which('soffice') or shutil.which('libreoffice')
+    paths = {}
+    for f in submission['files']:
+        path = f['path']
+        if f['type'] in CONVERT and soffice:
+            path = convert(soffice, path, cache) or path
+        elif f['type'] == 'pdf':
+            try:
+                with open(path, 'rb') as pdf:
+                    while pdf.read(1 << 20):
+                        pass
+            except OSError:
+                pass
+        paths[f['name']] = os.path.abspath(path)
+    return paths
+
+
+def convert(soffice, path, cache):
+    """ Convert the document at `path` to a PDF in `cache` and return its
+    path, or `None` if the conversion failed.
+    """
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    pdf = os.path.join(cache, f'{name}.pdf')
+    if os.path.exists(pdf) and os.path.getmtime(pdf) >= os.path.getmtime(path):
+        return pdf
+    os.makedirs(cache, exist_ok=True)
+    # A profile per folder, as instances sharing one cannot run at once
+    profile = f'-env:UserInstallation=file://' \
+        f'{os.path.abspath(os.path.join(cache, ".profile"))}'
+    try:
+        proc = sp.run([soffice, profile, '--headless', '--convert-to', 'pdf',
+                       '--outdir', cache, path],
+                      stdout=sp.DEVNULL, stderr=sp.DEVNULL, timeout=120)
+    except (OSError, sp.TimeoutExpired):
+        return None
+    return pdf if proc.returncode == 0 and os.path.exists(pdf) else None
@@ -0,0 +1,419 @@
+""" Run student programs with time and resource limits.
+
+Limits come from the `limits` setting in config.yaml, overridden by the
+`limits` of the assignment config:
+
+```yaml
+limits:
+  timeout: 60        # wall-clock seconds
+  cpu: 30            # CPU seconds (RLIMIT_CPU)
+  memory: 512m       # Java heap (-Xmx) of java commands, see `environment()`
+  address-space: 2g  # RLIMIT_AS, leave unset for JVMs
+  stdin: inherit     # inherit, null, or a file relative to the student
+  output: 1m         # output kept per program (first and last half)
+  log-size: 256m     # complete output written to disk, when it was cut
+```
+
+A program that runs out of time is killed together with every process it
+started. Output beyond `output` bytes is elided in the middle instead of
+being held in memory or flooding the terminal.
+"""
+
+import os
+import signal
+import subprocess as sp
+import sys
+import threading
+import time
+
+import agsmsg as msg
+import agstrace
+
+# Exit code reported for a killed program, as timeout(1) does
+TIMEOUT = 124
+
+UNITS = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+
+def size(value):
+    """ Return the number of bytes of a size such as `512m`. """
+
+    if value is None or isinstance(value, int):
+        return value
+    value = str(value).strip().lower()
+    if value[-1:] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+def limits(*configs):
+    """ Merge limit configs, later ones take precedence. """
+
+    merged = {}
+    for config in configs:
+        merged.update(config or {})
+    return merged
+
+
+def run(cmd, cwd='.', limits_=None, capture=False, step=None, log=None):
+    """ Run a shell command within `limits_` (see module doc).
+    Return a dict with keys `rc`, `out`, `err`, `timeout`, `truncated`,
+    `bytes`, `log` and `duration`.
+
+    `out` and `err` are only captured if `capture` is set. Otherwise the
+    output goes to the terminal, cut to `output` bytes if that is limited.
+    The complete output of a program exceeding `output` is written to
+    `log` (and `log`.stderr), if given. `step` labels the trace span of the
+    command.
+    """
+
+    with agstrace.span(cmd, student=agstrace.student(cwd), step=step) as s:
+        result = _run(cmd, cwd, limits_ or {}, capture, log)
+        s.update(rc=result['rc'], bytes=result['bytes'],
+                 truncated=result['truncated'])
+    return result
+
+
+def _run(cmd, cwd, limits_, capture, log):
+    result = {'rc': None, 'out': '', 'err': '', 'timeout': False,
+              'truncated': False, 'bytes': None, 'log': None, 'duration': 0}
+    interactive = limits_.get('stdin', 'inherit') == 'inherit' and \
+        sys.stdin.isatty()
+    try:
+        stdin = open_stdin(limits_, cwd)
+    except OSError as e:
+        err = f'Cannot open stdin: {e}'
+        if not capture:
+            print(err, file=sys.stderr)
+        result.update(rc=1, err=err if capture else '')
+        return result
+
+    # Messages so far come before the output of the program
+    msg.flush()
+    sys.stderr.flush()
+    limit = size(limits_.get('output'))
+    streams = []
+    if capture or limit:
+        log_size = size(limits_.get('log-size'))
+        streams = [Capture(limit, log, None if capture else sys.stdout.buffer,
+                           log_size),
+                   Capture(limit, log and f'{log}.stderr',
+                           None if capture else sys.stderr.buffer, log_size)]
+    pipe = sp.PIPE if streams else None
+    start = time.time()
+    proc = sp.Popen(limited(cmd, limits_), shell=True, cwd=cwd,
+                    env=environment(cmd, limits_), stdin=stdin, stdout=pipe,
+                    stderr=pipe, **GROUP)
+    terminal = foreground(proc.pid) if interactive else None
+    pumps = [threading.Thread(target=pump, args=(p, c), daemon=True)
+             for p, c in zip([proc.stdout, proc.stderr], streams)]
+    for t in pumps:
+        t.start()
+
+    try:
+        proc.wait(timeout=limits_.get('timeout'))
+    except sp.TimeoutExpired:
+        kill(proc.pid)
+        proc.wait()
+        result['timeout'] = True
+    except KeyboardInterrupt:
+        kill(proc.pid)
+        raise
+    finally:
+        for t in pumps:
+            t.join()
+        for c in streams:
+            c.close()
+        if terminal is not None:
+            foreground(terminal)
+        if stdin not in (None, sp.DEVNULL):
+            stdin.close()
+
+    result['rc'] = TIMEOUT if result['timeout'] else proc.returncode
+    result['duration'] = time.time() - start
+    if streams:
+        out, err = streams
+        result.update(truncated=out.truncated or err.truncated,
+                      bytes=out.size + err.size,
+                      log=log if out.file or err.file else None)
+        if capture:
+            result.update(out=out.text(), err=err.text())
+    return result
+
+
+async def run_async(cmd, cwd='.', limits_=None, step=None, log=None):
+    """ Run a shell command within `limits_` in an asyncio event loop.
+    stdout and stderr are captured together, and stdin is never the
+    terminal. Return a dict like `run()` does.
+    """
+
+    with agstrace.span(cmd, student=agstrace.student(cwd), step=step) as s:
+        result = await _run_async(cmd, cwd, limits_, log)
+        s.update(rc=result['rc'], bytes=result['bytes'],
+                 truncated=result['truncated'])
+    return result
+
+
+async def _run_async(cmd, cwd, limits_, log):
+    import asyncio
+
+    limits_ = dict(limits_ or {})
+    if limits_.get('stdin', 'inherit') == 'inherit':
+        limits_['stdin'] = 'null'
+    result = {'rc': 1, 'out': '', 'err': '', 'timeout': False,
+              'truncated': False, 'bytes': 0, 'log': None, 'duration': 0}
+    try:
+        stdin = open_stdin(limits_, cwd)
+    except OSError as e:
+        result['err'] = f'Cannot open stdin: {e}'
+        return result
+
+    output = Capture(size(limits_.get('output')), log,
+                     log_size=size(limits_.get('log-size')))
+
+    async def communicate(proc):
+        while True:
+            chunk = await proc.stdout.read(CHUNK)
+            if not chunk:
+                break
+            output.write(chunk)
+        await proc.wait()
+
+    start = time.time()
+    try:
+        proc = await asyncio.create_subprocess_shell(
+            limited(cmd, limits_), cwd=cwd, env=environment(cmd, limits_),
+            stdin=stdin, stdout=sp.PIPE, stderr=sp.STDOUT, **GROUP)
+        try:
+            await asyncio.wait_for(communicate(proc), limits_.get('timeout'))
+            result['rc'] = proc.returncode
+        except asyncio.TimeoutError:
+            kill(proc.pid)
+            await proc.wait()
+            result['rc'] = TIMEOUT
+            result['timeout'] = True
+    finally:
+        output.close()
+        if stdin is not sp.DEVNULL:
+            stdin.close()
+    result.update(out=output.text(), truncated=output.truncated,
+                  bytes=output.size, log=log if output.file else None,
+                  duration=time.time() - start)
+    return result
+
+
+# Bytes read from a pipe at once
+CHUNK = 1 << 16
+
+
+class Capture:
+    """ Output of a program, bounded to `limit` bytes (unbounded if `None`):
+    the first and the last half are kept and the middle is elided. Once
+    the limit is exceeded, the complete output also goes to the file `log`,
+    up to `log_size` bytes. If `echo` is a binary stream, the output is
+    written to it as it comes up to `limit` bytes, and the rest of the kept
+    output when the capture is closed.
+    """
+
+    def __init__(self, limit=None, log=None, echo=None, log_size=None):
+        self.limit = limit or None
+        self.log = log
+        self.log_size = log_size
+        self.echo = echo
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.size = 0
+        self.file = None
+
+    @property
+    def truncated(self):
+        return self.limit is not None and self.size > self.limit
+
+    def write(self, data):
+        if self.limit is None:
+            self.output(data)
+        elif self.size < self.limit:
+            # Everything is shown as it comes until output is elided, so a
+            # prompt past the head still shows up before the program waits
+            self.output(data[:self.limit - self.size])
+        self.size += len(data)
+        if self.file is not None:
+            self.spill(data)
+        room = len(data) if self.limit is None \
+            else self.limit - self.limit // 2 - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if not data:
+            return
+
+        self.tail += data
+        if self.truncated and self.file is None and self.log:
+            # Nothing is elided yet, head and tail are the whole output
+            os.makedirs(os.path.dirname(os.path.abspath(self.log)),
+                        exist_ok=True)
+            self.file = open(self.log, 'wb')
+            self.spill(self.head + self.tail)
+        # Trimmed in batches, so the tail is not copied on every write
+        if len(self.tail) > self.limit:
+            del self.tail[:len(self.tail) - self.limit // 2]
+
+    def spill(self, data):
+        if self.log_size is not None:
+            data = data[:max(self.log_size - self.file.tell(), 0)]
+        self.file.write(data)
+
+    def output(self, data):
+        if self.echo is not None and data:
+            self.echo.write(data)
+            self.echo.flush()
+
+    def kept_tail(self):
+        if not self.truncated:
+            return bytes(self.tail)
+        keep = self.limit // 2
+        return bytes(self.tail[len(self.tail) - keep:]) if keep else b''
+
+    def marker(self, elided=None):
+        if elided is None:
+            elided = self.size - len(self.head) - len(self.kept_tail())
+        where = f', complete output in {self.log}' if self.file else ''
+        return f'\n[... {elided} bytes elided{where} ...]\n'.encode()
+
+    def text(self):
+        """ Return the kept output, with a marker where it was cut. """
+
+        data = bytes(self.head)
+        if self.truncated:
+            data += self.marker()
+        data += self.kept_tail()
+        return data.decode(encoding='utf-8', errors='replace')
+
+    def close(self):
+        """ Echo the kept tail not shown yet, and close the log. """
+
+        if self.truncated:
+            tail = self.kept_tail()
+            # The first `limit` bytes were echoed already
+            start = self.size - len(tail)
+            if start > self.limit:
+                self.output(self.marker(start - self.limit) + tail)
+            else:
+                self.output(tail[self.limit - start:])
+        if self.file is not None:
+            self.file.close()
+
+
+def pump(pipe, capture):
+    """ Copy everything from `pipe` to `capture`. """
+
+    with pipe:
+        for chunk in iter(lambda: os.read(pipe.fileno(), CHUNK), b''):
+            capture.write(chunk)
+
+
+def open_stdin(limits_, cwd='.'):
+    """ Return the stdin for a program: `None` to inherit, `DEVNULL`, or
+    an open file relative to `cwd`.
+    """
+
+    stdin = limits_.get('stdin', 'inherit')
+    if stdin == 'inherit':
+        return None
+    if stdin == 'null':
+        return sp.DEVNULL
+    return open(os.path.join(cwd, stdin), 'rb')
+
+
+def program(cmd):
+    """ Return the first word of the shell command `cmd`. """
+
+    words = cmd.split(None, 1)
+    return words[0] if words else ''
+
+
+def heap(limits_):
+    """ Return the `-Xmx` option of `memory`, or `None` if unlimited. """
+
+    memory = size(limits_.get('memory'))
+    return f'-Xmx{memory // (1 << 20)}m' if memory else None
+
+
+def environment(cmd, limits_):
+    """ Return the environment of `cmd`. A java command gets its heap
+    limit as an option (see `limited()`), and javac none. Any other
+    command, e.g. a script of `custom run`, may start JVMs of its own, so
+    it gets the limit through JAVA_TOOL_OPTIONS, which every JVM reports
+    on stderr.
+    """
+
+    env = os.environ.copy()
+    xmx = heap(limits_)
+    if xmx and program(cmd) not in ('java', 'javac'):
+        env['JAVA_TOOL_OPTIONS'] = \
+            f'{env.get("JAVA_TOOL_OPTIONS", "")} {xmx}'.strip()
+    return env
+
+
+# A process group of its own, so a timeout can kill all of it. Set up by
+# subprocess without running Python in the child, which is not safe while
+# other threads run; before Python 3.11 only a new session can do that.
+GROUP = {'process_group': 0} if sys.version_info >= (3, 11) \
+    else {'start_new_session': True}
+
+
+def limited(cmd, limits_):
+    """ Return the shell command `cmd` with the limits of `limits_`: the
+    heap of a java command, and the rlimits, set by the shell before it
+    runs the program.
+    """
+
+    xmx = heap(limits_)
+    words = cmd.split(None, 1)
+    if xmx and len(words) == 2 and words[0] == 'java':
+        cmd = f'java {xmx} {words[1]}'
+    ulimits = []
+    cpu = limits_.get('cpu')
+    if cpu:
+        # The soft limit first, it cannot be above the hard one
+        ulimits += [f'ulimit -S -t {int(cpu)}', f'ulimit -H -t {int(cpu) + 1}']
+    space = size(limits_.get('address-space'))
+    if space:
+        ulimits.append(f'ulimit -v {space // 1024}')
+    if not ulimits:
+        return cmd
+    # Not run at all if a limit cannot be set, on a line of its own so it
+    # applies to every command of `cmd`
+    return f'{" && ".join(ulimits)} || exit 126\n{cmd}'
+
+
+def kill(pgid):
+    """ Kill a process group, ignoring one that is already gone. """
+
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def foreground(pgid):
+    """ Hand the terminal to process group `pgid`, so a program in its own
+    group can still read what the grader types. Return the previous group,
+    or `None` if the program runs in a session of its own.
+    """
+
+    fd = sys.stdin.fileno()
+    handler = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    try:
+        previous = os.tcgetpgrp(fd)
+        os.tcsetpgrp(fd, pgid)
+    except OSError:
+        return None
+    finally:
+        signal.signal(signal.SIGTTOU, handler)
+    # It may have stopped reading before it got the terminal
+    try:
+        os.killpg(pgid, signal.SIGCONT)
+    except ProcessLookupError:
+        pass
+    return previous
@@ -0,0 +1,49 @@
+""" Run grading tasks concurrently with asyncio.
+
+A task is a `(student, step)` pair with a coroutine function and the keys
+of the tasks it depends on. At most `jobs` tasks run at the same time, and
+a task starts as soon as all its dependencies are done.
+"""
+
+import asyncio
+import time
+
+
+def run(tasks, jobs=1, report=None):
+    """ Run `tasks`, a dict `{key: (dependencies, function)}` in which each
+    function is a coroutine function without arguments returning
+    `(exit code, detail)`.\n
+    `report(key, rc, detail, duration, done, total)` is called whenever a
+    task completes. Return `{key: (exit code, detail)}`.
+    """
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(_run(tasks, jobs, report))
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+async def _run(tasks, jobs, report):
+    semaphore = asyncio.Semaphore(jobs)
+    futures = {}
+    results = {}
+
+    async def task(key):
+        dependencies, function = tasks[key]
+        for dependency in dependencies:
+            await futures[dependency]
+        async with semaphore:
+            start = time.time()
+            rc, detail = await function()
+        results[key] = (rc, detail)
+        if report:
+            report(key, rc, detail, time.time() - start, len(results),
+                   len(tasks))
+
+    for key in tasks:
+        futures[key] = asyncio.ensure_future(task(key))
+    await asyncio.gather(*futures.values())
+    return results
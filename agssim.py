@@ -0,0 +1,197 @@
+""" Similarity of submissions, by winnowed fingerprints of Java tokens.
+
+The sources of a student are tokenized with comments dropped and every
+identifier, string and number replaced by a placeholder, so renaming
+variables or rewording comments does not hide a copy. Every `K` tokens are
+hashed, and winnowing keeps the smallest hash of every `W` hashes in a row:
+a match of at least `K + W - 1` tokens always shares a fingerprint.
+
+Pairs are counted through an inverted index from fingerprint to students,
+so the work grows with the number of shared fingerprints, not with the
+square of the class. Fingerprints in more than `MAX_SHARED` submissions
+are starter code or idioms and are left out.
+
+Indexes can be saved and loaded to compare with earlier semesters:
+
+```text
+header    magic b'AGSSIM1\\n', K, W, number of submissions  (<8sBBI)
+per submission
+          name length, number of fingerprints                 (<HI)
+          name (UTF-8), fingerprints (sorted uint32, little-endian)
+```
+"""
+
+from array import array
+import re
+import struct
+import sys
+import zlib
+
+K = 12
+W = 8
+MAX_SHARED = 10
+
+MAGIC = b'AGSSIM1\n'
+HEADER = struct.Struct('<8sBBI')
+ENTRY = struct.Struct('<HI')
+
+TOKEN = re.compile(r'''
+    (?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<string>"(?:\\.|[^"\\\n])*"?)
+  | (?P<char>'(?:\\.|[^'\\\n])*'?)
+  | (?P<number>\.?\d[\w.]*)
+  | (?P<word>[A-Za-z_$][\w$]*)
+  | (?P<op>\S)
+''', re.VERBOSE | re.DOTALL)
+
+KEYWORDS = frozenset('''
+    abstract assert boolean break byte case catch char class const continue
+    default do double else enum extends false final finally float for goto
+    if implements import instanceof int interface long native new null
+    package private protected public return short static strictfp super
+    switch synchronized this throw throws transient true try void volatile
+    while var
+'''.split())
+
+
+def tokenize(source):
+    """ Return the normalized tokens of the Java `source`: keywords and
+    operators as they are, `I` for identifiers, `S` for strings and
+    characters, `N` for numbers. Comments are dropped.
+    """
+
+    tokens = []
+    for match in TOKEN.finditer(source):
+        kind = match.lastgroup
+        if kind == 'comment':
+            continue
+        if kind == 'word':
+            word = match.group()
+            tokens.append(word if word in KEYWORDS else 'I')
+        elif kind in ('string', 'char'):
+            tokens.append('S')
+        elif kind == 'number':
+            tokens.append('N')
+        else:
+            tokens.append(match.group())
+    return tokens
+
+
+def fingerprint(tokens, k=K, w=W):
+    """ Return the winnowed hashes of the `k`-grams of `tokens`. """
+
+    hashes = [zlib.crc32(' '.join(tokens[i:i + k]).encode())
+              for i in range(len(tokens) - k + 1)]
+    if not hashes:
+        return set()
+    if len(hashes) < w:
+        return {min(hashes)}
+
+    selected = set()
+    last = -1
+    for i in range(len(hashes) - w + 1):
+        window = hashes[i:i + w]
+        low = min(window)
+        # The rightmost minimum, so a run of equal hashes counts once
+        at = i + w - 1 - window[::-1].index(low)
+        if at != last:
+            selected.add(low)
+            last = at
+    return selected
+
+
+def fingerprint_files(paths, k=K, w=W):
+    """ Return the fingerprints of all Java files `paths` of a student. """
+
+    hashes = set()
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            hashes |= fingerprint(tokenize(f.read()), k, w)
+    return hashes
+
+
+def pairs(docs, past=None, n=20, max_shared=MAX_SHARED):
+    """ Return the `n` most similar pairs of the submissions `docs`, with
+    each other and with the submissions `past` (both `{name: hashes}`):
+    `(name, other, shared, share of name, share of other)`, by the
+    Jaccard similarity of their fingerprints.
+    """
+
+    past = past or {}
+    postings = {}
+    for name, hashes in list(docs.items()) + list(past.items()):
+        for h in hashes:
+            postings.setdefault(h, []).append(name)
+
+    # Sizes without the fingerprints left out, so a copy of a submission
+    # with a lot of starter code is still a copy
+    shared = {}
+    sizes = dict.fromkeys(list(docs) + list(past), 0)
+    for names in postings.values():
+        if len(names) > max_shared:
+            continue
+        for name in names:
+            sizes[name] += 1
+        for i, a in enumerate(names):
+            if a not in docs:
+                # Earlier semesters are not compared with each other
+                break
+            for b in names[i + 1:]:
+                shared[a, b] = shared.get((a, b), 0) + 1
+
+    ranked = sorted(shared.items(), reverse=True,
+                    key=lambda p: p[1] / (sizes[p[0][0]] + sizes[p[0][1]] -
+                                          p[1]))
+    return [(a, b, count, count / sizes[a], count / sizes[b])
+            for (a, b), count in ranked[:n]]
+
+
+def save(path, docs, k=K, w=W):
+    """ Write the submissions `docs` (`{name: hashes}`) to `path`. """
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, k, w, len(docs)))
+        for name, hashes in sorted(docs.items()):
+            data = name.encode(encoding='utf-8')
+            values = array('I', sorted(hashes))
+            if sys.byteorder == 'big':
+                values.byteswap()
+            f.write(ENTRY.pack(len(data), len(values)))
+            f.write(data)
+            f.write(values.tobytes())
+
+
+def load(path, k=K, w=W):
+    """ Return the submissions `{name: hashes}` saved at `path`. Raise
+    `ValueError` if it is not an index of `k`-grams winnowed by `w`.
+    """
+
+    with open(path, 'rb') as f:
+        try:
+            return read(f, path, k, w)
+        except struct.error:
+            raise ValueError(f'{path} is truncated') from None
+
+
+def read(f, path, k, w):
+    """ Return the submissions in the open index file `f`. """
+
+    magic, k_, w_, count = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f'{path} is not a similarity index')
+    if (k_, w_) != (k, w):
+        raise ValueError(f'{path} has K={k_}, W={w_} instead of '
+                         f'K={k}, W={w}')
+    docs = {}
+    for _ in range(count):
+        size, number = ENTRY.unpack(f.read(ENTRY.size))
+        name = f.read(size).decode(encoding='utf-8')
+        values = array('I')
+        data = f.read(number * values.itemsize)
+        if len(data) != number * values.itemsize:
+            raise struct.error('short read')
+        values.frombytes(data)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        docs[name] = set(values)
+    return docs
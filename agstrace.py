@@ -0,0 +1,131 @@
+""" Spans of a grading run: how long every stage and command took.
+
+A span has a name (the command or stage), a category (`stage` or
+`command`) and fields such as the student, the step, the exit code and the
+bytes of output. Nothing is recorded until `enable()` is called.
+
+The spans can be written as Chrome trace events, to be opened in
+chrome://tracing or https://ui.perfetto.dev, and summarized as a table of
+the slowest commands.
+"""
+
+from contextlib import contextmanager
+import functools
+import json
+import os
+import threading
+import time
+
+import agsmsg as msg
+
+__enabled__ = False
+__spans__ = []
+__lock__ = threading.Lock()
+__origin__ = time.perf_counter()
+
+
+def enable():
+    """ Start recording spans. """
+
+    global __enabled__
+    __enabled__ = True
+
+
+@contextmanager
+def span(name, cat='command', **fields):
+    """ Record the `with` block as a span. The fields are yielded as a dict,
+    so the block can add to them, e.g. `rc` and `bytes`.
+    """
+
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        add(name, cat, start, time.perf_counter() - start, **fields)
+
+
+def stage(function):
+    """ Decorator recording every call of `function` as a stage span. The
+    messages of a stage are flushed when it ends.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            with span(function.__name__, 'stage'):
+                return function(*args, **kwargs)
+        finally:
+            msg.flush()
+    return wrapper
+
+
+def add(name, cat, start, duration, **fields):
+    """ Record a span that started at `start` (`time.perf_counter()`). """
+
+    if not __enabled__:
+        return
+    event = {'name': name, 'cat': cat, 'start': start, 'duration': duration,
+             'thread': threading.current_thread().name, 'fields': fields}
+    with __lock__:
+        __spans__.append(event)
+
+
+def student(cwd='.'):
+    """ Return the student a command in `cwd` belongs to, or `None`. """
+
+    name = os.path.basename(os.path.abspath(cwd))
+    return name if ' ' in name else None
+
+
+def write_chrome(path):
+    """ Write all spans as Chrome trace events to `path`.\n
+    Stages are on the lane of their thread, commands on the lane of their
+    student, so commands running concurrently do not overlap on a lane.
+    """
+
+    lanes = {}
+    events = []
+    with __lock__:
+        spans = list(__spans__)
+    for s in spans:
+        lane = s['thread'] if s['cat'] == 'stage' \
+            else s['fields'].get('student') or s['thread']
+        if lane not in lanes:
+            lanes[lane] = len(lanes)
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': os.getpid(), 'tid': lanes[lane],
+                           'args': {'name': lane}})
+        events.append({'name': s['name'], 'cat': s['cat'], 'ph': 'X',
+                       'ts': (s['start'] - __origin__) * 1e6,
+                       'dur': s['duration'] * 1e6,
+                       'pid': os.getpid(), 'tid': lanes[lane],
+                       'args': s['fields']})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def slowest(n=10, cat='command'):
+    """ Return the `n` longest spans of `cat`. """
+
+    with __lock__:
+        spans = [s for s in __spans__ if s['cat'] == cat]
+    return sorted(spans, key=lambda s: s['duration'], reverse=True)[:n]
+
+
+def print_summary(n=10):
+    """ Print the time of every stage and the `n` slowest commands. """
+
+    msg.info('Stages')
+    for s in sorted(slowest(len(__spans__), 'stage'),
+                    key=lambda s: s['start']):
+        msg.echo(f'  {msg.align_left(s["name"], 20)}{s["duration"]:9.2f}s')
+
+    msg.info(f'Slowest {n} commands')
+    for s in slowest(n):
+        fields = s['fields']
+        size = fields.get('bytes')
+        msg.echo(f'  {s["duration"]:8.2f}s  '
+                 f'{msg.align_left(fields.get("student") or "-", 24)}'
+                 f'{msg.align_left(fields.get("step") or "-", 12)}'
+                 f'rc={str(fields.get("rc")):5}'
+                 f'{"-" if size is None else size:>9}B  {s["name"][:60]}')
@@ -1,10 +1,17 @@
 from datetime import date
+import difflib
+import hashlib
+from itertools import zip_longest
 import os
-
-import yaml
+import pickle
+import shutil
 
 import agsmsg as msg
 
+# Parsed YAML configs, see `load_yaml()`
+CONFIG_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '.ags-cache', 'config')
+
 
 def current_semester():
     """ Return the current semester.\n
@@ -26,10 +33,9 @@ def read_config_glob(config="config/config.yaml"):
     """
 
     temp = []
-    with open(config, "r") as f:
-        conf_yaml = yaml.load(f, Loader=yaml.FullLoader)
-        for item in conf_yaml.values():
-            temp.append(item)
+    conf_yaml = load_yaml(config)
+    for item in conf_yaml.values():
+        temp.append(item)
 
     links = temp[0]
     for li in links:
@@ -49,8 +55,42 @@ def read_config_asmt(config: str):
         msg.warn(f'{config} not found. Loading default config...')
         config = f'{config.split("_")[0]}.yaml'
 
-    with open(config, 'r') as f:
-        __assignment_config__ = yaml.load(f, Loader=yaml.FullLoader)
+    __assignment_config__ = load_yaml(config)
+
+
+def load_yaml(path):
+    """ Parse a YAML file, with the C loader if PyYAML has one.
+
+    The result is pickled in .ags-cache/config/ and used instead of parsing
+    again as long as the mtime and size of the file do not change.
+    """
+
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    cache = os.path.join(CONFIG_CACHE, f'{name}.pickle')
+    try:
+        with open(cache, 'rb') as f:
+            cached_stamp, data = pickle.load(f)
+        if cached_stamp == stamp:
+            return data
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    import yaml
+    loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+    with open(path, 'r') as f:
+        data = yaml.load(f, Loader=loader)
+
+    try:
+        os.makedirs(CONFIG_CACHE, exist_ok=True)
+        tmp = f'{cache}.{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            pickle.dump((stamp, data), f)
+        os.replace(tmp, cache)
+    except OSError:
+        pass
+    return data
 
 
 def get_link(assignment):
@@ -68,18 +108,92 @@ def get_conf_asmt(setting=None):
     if __assignment_config__ is None:
         return None
     if setting is None:
-        print(__assignment_config__)
+        msg.echo(__assignment_config__)
     return __assignment_config__.get(setting)
 
 
-def init(force):
-    import shutil
+def link_tree(src, dst, mode='copy'):
+    """ Mirror all files in `src` into `dst`.\n
+    `mode` is one of `copy`, `hardlink` or `symlink`. Directories are always
+    created in `dst`, so new files written there stay private. Files already
+    up to date in `dst` are skipped, and hardlinks fall back to copies
+    across file systems.
+    """
+
+    for root, _, files in os.walk(src):
+        dst_root = os.path.normpath(
+            os.path.join(dst, os.path.relpath(root, src)))
+        os.makedirs(dst_root, exist_ok=True)
+        for f in files:
+            s = os.path.join(root, f)
+            d = os.path.join(dst_root, f)
+            same = os.path.exists(d) and os.path.samefile(s, d)
+            if mode == 'copy':
+                if same or os.path.islink(d):
+                    # Never write through a link into the shared file
+                    os.remove(d)
+                elif os.path.exists(d):
+                    ss, ds = os.stat(s), os.stat(d)
+                    if ss.st_size == ds.st_size and \
+                            ss.st_mtime <= ds.st_mtime:
+                        continue
+                shutil.copy2(s, d)
+                continue
+
+            if same and os.path.islink(d) == (mode == 'symlink'):
+                continue
+            if os.path.lexists(d):
+                os.remove(d)
+            if mode == 'symlink':
+                os.symlink(os.path.abspath(s), d)
+                continue
+            try:
+                os.link(s, d)
+            except OSError:
+                shutil.copy2(s, d)
+
+
+def output_lines(lines):
+    """ Yield non-blank lines with runs of whitespace collapsed. """
+    for line in lines:
+        line = ' '.join(line.split())
+        if line:
+            yield line
+
+
+def compare_output(actual, expected_file, context=10):
+    """ Compare program output with an expected output file, ignoring
+    whitespace and blank lines.\n
+    Return the similarity (0.0 to 1.0) and at most `context` lines of a
+    unified diff. Lines are compared as they are read; the diff is only
+    computed once they differ.
+    """
 
+    actual_lines = output_lines(actual.splitlines())
+    with open(expected_file, errors='replace') as f:
+        expected_lines = output_lines(f)
+        same = []
+        for a, e in zip_longest(actual_lines, expected_lines):
+            if a != e:
+                break
+            same.append(a)
+        else:
+            return 1.0, ''
+        a = same + ([a] if a is not None else []) + list(actual_lines)
+        e = same + ([e] if e is not None else []) + list(expected_lines)
+
+    ratio = difflib.SequenceMatcher(None, a, e, autojunk=False).ratio()
+    diff = difflib.unified_diff(e, a, 'expected', 'actual', lineterm='')
+    return ratio, ''.join(f'{line}\n' for _, line in zip(range(context),
+                                                           diff))
+
+
+def init(force):
     msg.info('Initializing...')
     if force:
         option = msg.ask_yn('Force initialize will possibly remove all files, '
                             'continue with <force> flag?',
-                            msgtype='warn')
+                            type_='warn', default=False)
         if not option:
             force = False
 
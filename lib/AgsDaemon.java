@@ -0,0 +1,124 @@
+import java.io.BufferedReader;
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.File;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.List;
+import javax.tools.JavaCompiler;
+import javax.tools.ToolProvider;
+
+/**
+ * Long-lived JVM helper used by agsdaemon.py.
+ *
+ * Reads one tab separated request per line from stdin:
+ *
+ * <pre>
+ * compile  cwd  classpath  file...
+ * </pre>
+ *
+ * and answers each with a header line "exitcode length" followed by
+ * exactly length bytes of UTF-8 output. Relative files and classpath
+ * entries are resolved against cwd; "dir/*" expands to the jars in dir.
+ */
+public class AgsDaemon {
+
+    public static void main(String[] args) throws Exception {
+        PrintStream protocol = System.out;
+        BufferedReader in = new BufferedReader(
+                new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        System.setIn(new ByteArrayInputStream(new byte[0]));
+
+        String line;
+        while ((line = in.readLine()) != null) {
+            ByteArrayOutputStream buf = new ByteArrayOutputStream();
+            int rc;
+            try {
+                rc = handle(line.split("\t", -1), buf);
+            } catch (Throwable t) {
+                t.printStackTrace(new PrintStream(buf, true, "UTF-8"));
+                rc = 1;
+            }
+            byte[] payload = buf.toByteArray();
+            protocol.print(rc + " " + payload.length + "\n");
+            protocol.write(payload);
+            protocol.flush();
+        }
+    }
+
+    private static int handle(String[] req, ByteArrayOutputStream buf)
+            throws Exception {
+        if (req.length < 3) {
+            throw new IllegalArgumentException("Malformed request");
+        }
+        File cwd = new File(req[1]);
+        List<File> cp = classpath(cwd, req[2]);
+        String[] rest = Arrays.copyOfRange(req, 3, req.length);
+        if (req[0].equals("compile")) {
+            return compile(cwd, cp, rest, buf);
+        }
+        throw new IllegalArgumentException("Unknown operation: " + req[0]);
+    }
+
+    private static List<File> classpath(File cwd, String spec) {
+        List<File> entries = new ArrayList<File>();
+        for (String e : spec.split(File.pathSeparator)) {
+            if (e.isEmpty()) {
+                continue;
+            }
+            File f = new File(e);
+            if (!f.isAbsolute()) {
+                f = new File(cwd, e);
+            }
+            if (!f.getName().equals("*")) {
+                entries.add(f);
+                continue;
+            }
+            File[] jars = f.getParentFile().listFiles();
+            if (jars == null) {
+                continue;
+            }
+            Arrays.sort(jars);
+            for (File jar : jars) {
+                if (jar.getName().toLowerCase().endsWith(".jar")) {
+                    entries.add(jar);
+                }
+            }
+        }
+        return entries;
+    }
+
+    private static int compile(File cwd, List<File> cp, String[] files,
+            ByteArrayOutputStream buf) throws Exception {
+        JavaCompiler javac = ToolProvider.getSystemJavaCompiler();
+        if (javac == null) {
+            throw new IllegalStateException("No system Java compiler");
+        }
+
+        StringBuilder path = new StringBuilder();
+        for (File f : cp) {
+            if (path.length() > 0) {
+                path.append(File.pathSeparator);
+            }
+            path.append(f.getPath());
+        }
+        List<String> argv = new ArrayList<String>();
+        argv.add("-cp");
+        argv.add(path.toString());
+        for (String f : files) {
+            argv.add(new File(cwd, f).getPath());
+        }
+
+        ByteArrayOutputStream diagnostics = new ByteArrayOutputStream();
+        int rc = javac.run(null, diagnostics, diagnostics,
+                argv.toArray(new String[0]));
+        // Report files relative to cwd, as the javac command does
+        String text = new String(diagnostics.toByteArray())
+                .replace(cwd.getPath() + File.separator, "");
+        buf.write(text.getBytes(StandardCharsets.UTF_8));
+        return rc;
+    }
+}
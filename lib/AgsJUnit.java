@@ -0,0 +1,146 @@
+import java.io.FileOutputStream;
+import java.io.PrintStream;
+import java.util.HashMap;
+import java.util.Map;
+import junit.runner.Version;
+import org.junit.internal.TextListener;
+import org.junit.runner.Description;
+import org.junit.runner.JUnitCore;
+import org.junit.runner.Result;
+import org.junit.runner.notification.Failure;
+import org.junit.runner.notification.RunListener;
+
+/**
+ * Drop-in for JUnitCore used by agsjunit.py.
+ *
+ * <pre>
+ * java AgsJUnit events class...
+ * </pre>
+ *
+ * prints the same console output as JUnitCore and writes one JSON object
+ * per line to the file events:
+ *
+ * <pre>
+ * {"event": "started", "class": "...", "test": "..."}
+ * {"event": "finished", "class": "...", "test": "...",
+ *  "status": "passed|failed|skipped|ignored", "time": 0.012,
+ *  "message": "..."}
+ * </pre>
+ *
+ * Every line is flushed at once, so a test that hangs until the program
+ * is killed is the one that started and never finished.
+ */
+public class AgsJUnit extends RunListener {
+
+    private final PrintStream events;
+    private final Map<Description, Long> started =
+            new HashMap<Description, Long>();
+    private final Map<Description, String[]> outcome =
+            new HashMap<Description, String[]>();
+
+    public AgsJUnit(PrintStream events) {
+        this.events = events;
+    }
+
+    public static void main(String[] args) throws Exception {
+        if (args.length < 1) {
+            System.err.println("Usage: java AgsJUnit events class...");
+            System.exit(2);
+        }
+        PrintStream events = new PrintStream(
+                new FileOutputStream(args[0]), true, "UTF-8");
+        JUnitCore core = new JUnitCore();
+        core.addListener(new TextListener(System.out));
+        core.addListener(new AgsJUnit(events));
+
+        System.out.println("JUnit version " + Version.id());
+        Class<?>[] classes = new Class<?>[args.length - 1];
+        for (int i = 1; i < args.length; i++) {
+            try {
+                classes[i - 1] = Class.forName(args[i]);
+            } catch (ClassNotFoundException e) {
+                System.out.println("Could not find class: " + args[i]);
+                System.exit(1);
+            }
+        }
+        Result result = core.run(classes);
+        events.close();
+        System.exit(result.wasSuccessful() ? 0 : 1);
+    }
+
+    @Override
+    public void testStarted(Description d) {
+        started.put(d, System.nanoTime());
+        emit(d, "started", null, null, null);
+    }
+
+    @Override
+    public void testFailure(Failure f) {
+        if (!f.getDescription().isTest()) {
+            // e.g. @BeforeClass failed, no test of the class starts
+            emit(f.getDescription(), "finished", "failed", 0.0,
+                    f.getMessage());
+            return;
+        }
+        outcome.put(f.getDescription(),
+                new String[] {"failed", f.getMessage()});
+    }
+
+    @Override
+    public void testAssumptionFailure(Failure f) {
+        outcome.put(f.getDescription(),
+                new String[] {"skipped", f.getMessage()});
+    }
+
+    @Override
+    public void testIgnored(Description d) {
+        emit(d, "finished", "ignored", 0.0, null);
+    }
+
+    @Override
+    public void testFinished(Description d) {
+        Long start = started.remove(d);
+        double time = start == null ? 0.0
+                : (System.nanoTime() - start) / 1e9;
+        String[] o = outcome.remove(d);
+        if (o == null) {
+            emit(d, "finished", "passed", time, null);
+        } else {
+            emit(d, "finished", o[0], time, o[1]);
+        }
+    }
+
+    private void emit(Description d, String event, String status,
+            Double time, String message) {
+        StringBuilder line = new StringBuilder();
+        line.append("{\"event\": ").append(quote(event));
+        line.append(", \"class\": ").append(quote(d.getClassName()));
+        line.append(", \"test\": ").append(quote(d.getMethodName()));
+        if (status != null) {
+            line.append(", \"status\": ").append(quote(status));
+            line.append(", \"time\": ").append(time);
+            line.append(", \"message\": ").append(quote(message));
+        }
+        line.append("}");
+        synchronized (events) {
+            events.println(line);
+        }
+    }
+
+    private static String quote(String s) {
+        if (s == null) {
+            return "null";
+        }
+        StringBuilder q = new StringBuilder("\"");
+        for (char c : s.toCharArray()) {
+            if (c == '"' || c == '\\') {
+                q.append('\\').append(c);
+            } else if (c < 0x20) {
+                q.append(String.format("\\u%04x", (int) c));
+            } else {
+                q.append(c);
+            }
+        }
+        return q.append('"').toString();
+    }
+}